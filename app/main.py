@@ -1,10 +1,41 @@
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from  routers import search, links, sitemap, yt_transcript
+from  routers import search, links, sitemap, yt_transcript, batch, jobs, metrics, parse_pool
+from routers.compression import StreamGZipMiddleware
+from routers.cache import create_cache
+from routers.errors import APIError, error_response
+from routers.client import create_client
+from routers.jobs import create_job_queue
+from routers.sitemap_snapshots import SnapshotStore
+from routers.transcript_store import TranscriptStore
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the shared HTTP client, response cache, transcript store and sitemap snapshots and starts the job workers on
+    startup, and stops and closes them on shutdown."""
+
+    app.state.http_client = create_client()
+    app.state.cache = create_cache()
+    app.state.transcript_store = TranscriptStore()
+    app.state.snapshot_store = SnapshotStore()
+    app.state.jobs = create_job_queue()
+    app.state.jobs.start(app.state.http_client, app.state.cache)
+    yield
+    await app.state.jobs.close()
+    await app.state.http_client.aclose()
+    await app.state.cache.close()
+    app.state.transcript_store.close()
+    app.state.snapshot_store.close()
+    parse_pool.shutdown()
+
 
 # FastAPI app instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # CORS Configuration
 origins = [
@@ -20,12 +51,27 @@ app.add_middleware(
     allow_credentials=True,
 )
 
+# Compress larger responses (transcripts, sitemaps) for clients that accept gzip, NDJSON streams are left as they are
+app.add_middleware(StreamGZipMiddleware, minimum_size=1000)
+
+# Time every request, outermost so the time spent compressing is included
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+# Answer failures with their real status code and a typed JSON body, see routers.errors
+app.add_exception_handler(APIError, error_response)
+app.add_exception_handler(httpx.HTTPError, error_response)
+app.add_exception_handler(TimeoutError, error_response)
+
 
 # Register routers with app
 app.include_router(search.router)
 app.include_router(links.router)
 app.include_router(sitemap.router)
 app.include_router(yt_transcript.router)
+app.include_router(batch.router)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
 
 
 @app.get("/")
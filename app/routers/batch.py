@@ -0,0 +1,112 @@
+"""Batch router, runs the blog index and sitemap analysis for many URLs in one request."""
+import os
+import asyncio
+import httpx
+import orjson
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable
+from urllib.parse import urlsplit
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from .cache import ResponseCache, get_cache
+from .client import get_client
+from .deadline import get_deadline
+from .errors import from_exception
+from .links import blog_index
+from .sitemap import find_sitemap
+
+# Most URLs accepted in one batch
+BATCH_MAX_URLS = int(os.environ.get('BATCH_MAX_URLS') or 500)
+
+# URLs processed at the same time, overall and per host
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY') or 8)
+BATCH_PER_HOST = int(os.environ.get('BATCH_PER_HOST') or 1)
+
+# Define API Router
+router = APIRouter(
+    prefix="/batch",
+    tags=['batch'],
+)
+
+
+class BatchRequest(BaseModel):
+    urls: list[str] = Field(min_length=1, max_length=BATCH_MAX_URLS)
+    concurrency: int = Field(default=BATCH_CONCURRENCY, ge=1, le=32)
+
+
+async def run_batch(
+        urls: list[str],
+        job: Callable[[str], Awaitable[Any]],
+        concurrency: int,
+        per_host: int = BATCH_PER_HOST
+) -> AsyncIterator[tuple[str, Any]]:
+    """Runs job for every URL on a bounded pool and yields (url, result) pairs in the order they finish.
+
+    No more than per_host URLs of the same host run at once, so one site is not hit by a whole batch."""
+
+    pool = asyncio.Semaphore(concurrency)
+    hosts = {}
+
+    async def run(url: str) -> tuple[str, Any]:
+        host = hosts.setdefault(urlsplit(url).hostname, asyncio.Semaphore(per_host))
+        # Wait for the host first so a busy host does not hold a pool slot
+        async with host, pool:
+            try:
+                return url, await job(url)
+            except Exception as e:
+                return url, from_exception(e).body()
+
+    tasks = [asyncio.create_task(run(url)) for url in dict.fromkeys(urls)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def stream_batch(results: AsyncIterator[tuple[str, Any]]) -> StreamingResponse:
+    """Sends every result as its own NDJSON line as soon as it is ready."""
+
+    async def lines() -> AsyncIterator[bytes]:
+        async for url, result in results:
+            yield orjson.dumps({'url': url, 'result': result}) + b'\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+"""Path Operations"""
+@router.post("/blog-index")
+async def batch_blog_index(
+    batch: BatchRequest,
+    client: Annotated[httpx.AsyncClient, Depends(get_client)],
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    deadline: Annotated[float | None, Depends(get_deadline)] = None,
+) -> StreamingResponse:
+    """Runs /blog-index for every URL, streaming back one NDJSON record per URL as it finishes. A time budget
+    (timeout_ms or X-Timeout-Ms) applies to the whole batch."""
+
+    return stream_batch(run_batch(
+        batch.urls,
+        lambda url: blog_index(url, client, cache, deadline),
+        batch.concurrency
+    ))
+
+
+@router.post("/sitemap")
+async def batch_sitemap(
+    batch: BatchRequest,
+    client: Annotated[httpx.AsyncClient, Depends(get_client)],
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    deadline: Annotated[float | None, Depends(get_deadline)] = None,
+) -> StreamingResponse:
+    """Runs /sitemap for every URL, streaming back one NDJSON record per URL as it finishes. A time budget (timeout_ms
+    or X-Timeout-Ms) applies to the whole batch."""
+
+    return stream_batch(run_batch(
+        batch.urls,
+        lambda url: find_sitemap(url, client, cache, deadline=deadline),
+        batch.concurrency
+    ))
@@ -0,0 +1,83 @@
+"""Circuit breakers for upstreams.
+
+Once an upstream has failed BREAKER_FAILURES times in a row its circuit opens, and calls to it fail at once with
+CircuitOpenError instead of each waiting out a timeout. After BREAKER_RESET seconds one trial call is let through: it
+closes the circuit when it succeeds and opens it again when it fails.
+
+The outbound scheduler keeps one breaker per host, the YouTube and Google search clients keep one each."""
+import os
+import time
+
+import httpx
+
+from .metrics import CIRCUIT_OPEN
+
+
+# Failures in a row that open a circuit, and seconds before a trial call is let through
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES') or 5)
+BREAKER_RESET = float(os.environ.get('BREAKER_RESET') or 30)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of calling an upstream whose circuit is open. A TransportError, so callers that already treat an
+    unreachable upstream as a failure treat this one the same way."""
+
+    def __init__(self, name: str, retry_after: float, request: httpx.Request | None = None) -> None:
+        super().__init__(f'{name} is failing, retry in {retry_after:.0f} seconds', request=request)
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Failure count and state of the circuit of one upstream."""
+
+    def __init__(
+            self,
+            name: str,
+            label: str | None = None,
+            failures: int = BREAKER_FAILURES,
+            reset: float = BREAKER_RESET
+    ) -> None:
+        self.name = name
+        # Metric label, hosts past METRICS_MAX_HOSTS share one
+        self.label = label or name
+        self.threshold = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def check(self, request: httpx.Request | None = None) -> None:
+        """Raises CircuitOpenError when the upstream must not be called now. Otherwise the caller must report the
+        outcome with success(), failure() or release()."""
+
+        if self.opened_at is None:
+            return
+
+        waited = time.monotonic() - self.opened_at
+        if waited < self.reset:
+            raise CircuitOpenError(self.name, self.reset - waited, request)
+        # Half-open, only one trial call at a time
+        if self._trial:
+            raise CircuitOpenError(self.name, 1, request)
+        self._trial = True
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            CIRCUIT_OPEN.set(self.label, value=0)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._trial = False
+        # A failed trial opens the circuit again for another reset period
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+            CIRCUIT_OPEN.set(self.label, value=1)
+
+    def release(self) -> None:
+        """Ends a call that was cancelled before it had an outcome."""
+
+        self._trial = False
@@ -0,0 +1,293 @@
+"""Response cache for upstream calls.
+
+Two tiers: a bounded in-process LRU, and an optional shared tier (SQLite on local disk or a Redis-compatible server)
+picked with the CACHE_BACKEND environment variable. Every namespace (endpoint) has its own TTL and a shorter TTL for
+"empty" results. Concurrent misses on the same key share one upstream call."""
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable
+
+import orjson
+from fastapi import Request
+
+from .deadline import wait_until
+from .url_list import encode
+
+
+# Namespace: (TTL, empty result TTL) in seconds
+CACHE_TTLS = {
+    'search': (
+        float(os.environ.get('CACHE_TTL_SEARCH') or 3600),
+        float(os.environ.get('CACHE_TTL_SEARCH_EMPTY') or 300),
+    ),
+    'transcript': (
+        float(os.environ.get('CACHE_TTL_TRANSCRIPT') or 86400),
+        float(os.environ.get('CACHE_TTL_TRANSCRIPT_EMPTY') or 3600),
+    ),
+    'sitemap': (
+        float(os.environ.get('CACHE_TTL_SITEMAP') or 21600),
+        float(os.environ.get('CACHE_TTL_SITEMAP_EMPTY') or 600),
+    ),
+}
+
+# Seconds between deletions of the expired rows of the SQLite tier
+CACHE_SWEEP_INTERVAL = float(os.environ.get('CACHE_SWEEP_INTERVAL') or 600)
+
+
+class LRUCache:
+    """In-process cache holding values of at most max_bytes in total, evicting the least recently used first. A value's
+    size is the length of its JSON encoding, so a sitemap of 50,000 URLs weighs what it holds and not as one entry."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Key: (expires, value, size)
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value, _ = entry
+        if expires <= time.time():
+            self._discard(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: float, size: int) -> None:
+        self._discard(key)
+        # Never kept, it would evict everything else
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (time.time() + ttl, value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted[2]
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """Shared tier stored in a SQLite file, usable by every worker on the same machine. Expired rows are deleted when
+    read, and all of them every CACHE_SWEEP_INTERVAL seconds by the next write."""
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        self._swept = time.time()
+
+    def _get(self, key: str) -> bytes | None:
+        with self._lock:
+            row = self._db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+            return row[0]
+
+    def _set(self, key: str, value: bytes, ttl: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                (key, value, now + ttl)
+            )
+            # Keys that are never read again would otherwise stay in the file for good
+            if now - self._swept >= CACHE_SWEEP_INTERVAL:
+                self._swept = now
+                self._db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+
+    async def get(self, key: str) -> bytes | None:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def close(self) -> None:
+        self._db.close()
+
+
+class RedisBackend:
+    """Shared tier on a Redis-compatible server. Needs the redis package installed."""
+
+    def __init__(self, url: str) -> None:
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError('CACHE_BACKEND=redis needs the redis package installed')
+
+        self._redis = redis.from_url(url)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self._redis.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self._redis.set(key, value, px=int(ttl * 1000))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+class FetchAbandoned(Exception):
+    """Raised to the requests waiting on a fetch when the request making it is cancelled."""
+
+
+class ResponseCache:
+    """Two tier cache with single-flight de-duplication and hit/miss counters per namespace."""
+
+    def __init__(self, memory: LRUCache, shared: SQLiteBackend | RedisBackend | None = None) -> None:
+        self.memory = memory
+        self.shared = shared
+        self.counters = defaultdict(lambda: {'hits': 0, 'misses': 0, 'empty_hits': 0, 'coalesced': 0})
+        self._inflight = {}
+
+    async def _lookup(self, namespace: str, key: str) -> tuple[bool, Any]:
+        """Returns whether the key was found and its value, checking memory before the shared tier."""
+
+        value = self.memory.get(key)
+        if value is not None:
+            return True, value[1]
+
+        if self.shared is not None:
+            try:
+                raw = await self.shared.get(key)
+            except Exception:
+                raw = None
+            if raw is not None:
+                empty, value = orjson.loads(raw)
+                # Keep it in memory for a short while, the shared tier stays the source of truth
+                self.memory.set(key, (empty, value), CACHE_TTLS[namespace][1], len(raw))
+                return True, value
+
+        return False, None
+
+    async def _store(self, key: str, value: Any, empty: bool, ttl: float) -> None:
+        raw = orjson.dumps([empty, value], default=encode)
+        self.memory.set(key, (empty, value), ttl, len(raw))
+        if self.shared is not None:
+            try:
+                await self.shared.set(key, raw, ttl)
+            except Exception:
+                pass
+
+    async def get_or_fetch(
+            self,
+            namespace: str,
+            key: str,
+            fetch: Callable[[], Awaitable[Any]],
+            is_empty: Callable[[Any], bool] = lambda value: not value,
+            is_failure: Callable[[Any], bool] = lambda value: False,
+            deadline: float | None = None,
+    ) -> Any:
+        """Returns the cached value for the key, or awaits fetch() and caches its result.
+
+        :param namespace: Endpoint name, selects the TTLs from CACHE_TTLS
+        :param key: Identifies the request within the namespace
+        :param fetch: Makes the upstream call on a miss
+        :param is_empty: Results it accepts are cached with the shorter empty TTL
+        :param is_failure: Results it accepts are returned but never cached
+        :param deadline: Event loop time after which waiting for another request's fetch raises TimeoutError"""
+
+        key = f'{namespace}:{key}'
+        counters = self.counters[namespace]
+
+        found, value = await self._lookup(namespace, key)
+        if found:
+            counters['hits'] += 1
+            if is_empty(value):
+                counters['empty_hits'] += 1
+            return value
+
+        # Another request is already fetching this key, wait for its result. If that request is cancelled, the first
+        # waiter to wake up fetches the key itself and the others wait for it instead
+        if key in self._inflight:
+            counters['coalesced'] += 1
+        while key in self._inflight:
+            try:
+                return await wait_until(asyncio.shield(self._inflight[key]), deadline)
+            except FetchAbandoned:
+                pass
+
+        counters['misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            # Only this request is cancelled, not the ones waiting on it
+            future.set_exception(FetchAbandoned())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(value)
+        if not is_failure(value):
+            ttl, empty_ttl = CACHE_TTLS[namespace]
+            empty = is_empty(value)
+            await self._store(key, value, empty, empty_ttl if empty else ttl)
+
+        return value
+
+    async def peek(self, namespace: str, key: str) -> Any | None:
+        """Returns the cached value for the key without fetching it or counting a hit or miss."""
+
+        found, value = await self._lookup(namespace, f'{namespace}:{key}')
+        return value if found else None
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Hit, miss and coalesced request counts per namespace."""
+
+        return {namespace: dict(counts) for namespace, counts in self.counters.items()}
+
+    async def close(self) -> None:
+        if self.shared is not None:
+            await self.shared.close()
+
+
+def create_cache() -> ResponseCache:
+    """Builds the app-wide cache from the environment:
+    CACHE_MAX_MB, CACHE_BACKEND (sqlite or redis), CACHE_SQLITE_PATH and CACHE_REDIS_URL."""
+
+    memory = LRUCache(int(float(os.environ.get('CACHE_MAX_MB') or 128) * 1024 * 1024))
+
+    backend = (os.environ.get('CACHE_BACKEND') or '').casefold()
+    shared = None
+    if backend == 'sqlite':
+        shared = SQLiteBackend(os.environ.get('CACHE_SQLITE_PATH') or 'writebolt-cache.sqlite3')
+    elif backend == 'redis':
+        shared = RedisBackend(os.environ.get('CACHE_REDIS_URL') or 'redis://localhost:6379/0')
+
+    return ResponseCache(memory, shared)
+
+
+def get_cache(request: Request) -> ResponseCache:
+    """Dependency that hands routers the cache opened in the app lifespan."""
+
+    return request.app.state.cache
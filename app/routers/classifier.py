@@ -0,0 +1,166 @@
+"""Sitemap link classification.
+
+A link belongs to every category one of whose keywords appears in its path. Rather than testing every keyword of every
+category against every link, a Classifier compiles all keywords into one regex and runs it once over each link's path:
+the keywords it finds are mapped to a bitmask of their categories, and each distinct bitmask to its tuple of category
+names, so a link costs one casefold, one path match and one findall whatever the number of categories.
+
+Callers can add their own categories per request (see parse_rules), on top of the default CATEGORIES."""
+import re
+import functools
+
+from .errors import BadRequest
+
+
+# Category names and the path keywords that put a link in them
+CATEGORIES = {
+    'pages': ('pages', 'page'),
+    'products': ('products', 'product'),
+    'blogs': ('blogs', 'blog', 'post', 'posts'),
+}
+
+# Limits on the categories a request may define
+MAX_CATEGORIES = 20
+MAX_KEYWORDS = 50
+MAX_KEYWORD_LENGTH = 64
+
+# Skips the scheme and host of a URL (or none of a relative one) and captures its path, as urlsplit would
+_PATH = re.compile(r'(?:[a-z][a-z0-9+.\-]*:)?(?://[^/?#]*)?([^?#]*)')
+
+
+def _overlaps(masks: dict[str, int]) -> bool:
+    """Whether a keyword of other categories can start inside another keyword, where a search that consumes the outer
+    match would miss it."""
+
+    # Categories of the keywords starting with each prefix
+    starts = {}
+    for keyword, mask in masks.items():
+        for end in range(1, len(keyword) + 1):
+            starts[keyword[:end]] = starts.get(keyword[:end], 0) | mask
+
+    for keyword, mask in masks.items():
+        for offset in range(1, len(keyword)):
+            suffix = keyword[offset:]
+            # Keywords that start with the rest of this one, or that the rest of this one starts with
+            inner = starts.get(suffix, 0)
+            for end in range(1, len(suffix)):
+                inner |= masks.get(suffix[:end], 0)
+            if inner & ~mask:
+                return True
+    return False
+
+
+class Classifier:
+    """Classifies links into the categories of rules, a mapping of category name to path keywords."""
+
+    def __init__(self, rules: dict[str, tuple[str, ...]] = CATEGORIES) -> None:
+        self.names = tuple(rules)
+
+        # Bitmask of the categories each keyword belongs to
+        masks = {}
+        for bit, keywords in enumerate(rules.values()):
+            for keyword in keywords:
+                keyword = keyword.casefold()
+                masks[keyword] = masks.get(keyword, 0) | 1 << bit
+
+        # Where one keyword begins another, a match of the longer one is a match of both
+        self._masks = {}
+        for keyword, mask in masks.items():
+            for end in range(1, len(keyword)):
+                mask |= masks.get(keyword[:end], 0)
+            self._masks[keyword] = mask
+
+        # Longest first, so the alternation prefers the keyword that implies the most categories. When keywords can
+        # overlap, a lookahead finds one at every position instead of skipping past each match. It is guarded by the
+        # keywords' first characters, which lets the regex engine skip the positions no keyword starts at
+        alternation = '|'.join(re.escape(keyword) for keyword in sorted(masks, key=len, reverse=True))
+        if not alternation:
+            self._keywords = None
+        elif _overlaps(self._masks):
+            first = ''.join(re.escape(char) for char in sorted({keyword[0] for keyword in masks}))
+            self._keywords = re.compile(f'(?=[{first}])(?=({alternation}))')
+        else:
+            self._keywords = re.compile(alternation)
+
+        # Categories per bitmask, and the fallback category per sitemap URL
+        self._results = {0: ()}
+        self._sitemaps = {}
+
+    def _named(self, mask: int) -> tuple[str, ...]:
+        names = self._results.get(mask)
+        if names is None:
+            names = self._results[mask] = tuple(name for bit, name in enumerate(self.names) if mask >> bit & 1)
+        return names
+
+    def _mask(self, url: str) -> int:
+        if self._keywords is None:
+            return 0
+        url = url.casefold()
+        path = _PATH.match(url)
+        mask = 0
+        for keyword in self._keywords.findall(url, path.start(1), path.end(1)):
+            mask |= self._masks[keyword]
+        return mask
+
+    def classify(self, link: str, sitemap_url: str | None = None) -> tuple[str, ...]:
+        """Returns the categories whose keywords appear in the link path.
+
+        Links that match nothing take the first category of the sitemap file they were listed in, e.g. every link in
+        post-sitemap.xml is a blog."""
+
+        mask = self._mask(link)
+        if mask:
+            return self._named(mask)
+        if not sitemap_url:
+            return ()
+
+        fallback = self._sitemaps.get(sitemap_url)
+        if fallback is None:
+            mask = self._mask(sitemap_url)
+            # The lowest bit is the first category
+            fallback = self._named(mask & -mask)
+            # Bounded, a crawl only lists so many sitemaps but a classifier may live for the whole process
+            if len(self._sitemaps) < 10000:
+                self._sitemaps[sitemap_url] = fallback
+        return fallback
+
+
+def parse_rules(specs: list[str] | None) -> dict[str, tuple[str, ...]]:
+    """Reads user-defined categories, each given as "name:keyword,keyword", on top of the default CATEGORIES. A
+    category with the name of a default one replaces its keywords."""
+
+    rules = dict(CATEGORIES)
+    for spec in specs or []:
+        name, _, keywords = spec.partition(':')
+        name = name.strip()
+        keywords = tuple(dict.fromkeys(
+            keyword.strip().casefold() for keyword in keywords.split(',') if keyword.strip()
+        ))
+        if not name or not keywords:
+            raise BadRequest('categories must be given as name:keyword,keyword', error='invalid_category')
+        if len(keywords) > MAX_KEYWORDS or max(map(len, keywords)) > MAX_KEYWORD_LENGTH:
+            raise BadRequest(
+                f'a category may have at most {MAX_KEYWORDS} keywords of up to {MAX_KEYWORD_LENGTH} characters',
+                error='invalid_category'
+            )
+        rules[name] = keywords
+
+    if len(rules) > len(CATEGORIES) + MAX_CATEGORIES:
+        raise BadRequest(f'at most {MAX_CATEGORIES} categories may be added', error='invalid_category')
+
+    return rules
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled(rules: tuple[tuple[str, tuple[str, ...]], ...]) -> Classifier:
+    return Classifier(dict(rules))
+
+
+def get_classifier(specs: list[str] | None = None) -> Classifier:
+    """The classifier of the default categories plus the user-defined ones in specs (see parse_rules). Classifiers of
+    recently used rules are kept compiled."""
+
+    return _compiled(tuple(parse_rules(specs).items()))
+
+
+DEFAULT_CLASSIFIER = get_classifier()
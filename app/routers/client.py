@@ -0,0 +1,63 @@
+"""Shared async HTTP client used by every router."""
+import os
+
+import httpx
+from fastapi import Request
+
+from .http_cache import HTTPCache
+from .robots import RobotsCache
+from .scheduler import Scheduler
+
+
+def _env(name: str, default: float) -> float:
+    """Reads a numeric setting from the environment, falling back to the default."""
+
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+class CrawlClient(httpx.AsyncClient):
+    """AsyncClient whose requests all go through the outbound scheduler. It also holds the parsed robots.txt of every
+    host it has visited, and the parsed pages and sitemaps that can be revalidated."""
+
+    def __init__(self, scheduler: Scheduler, **kwargs) -> None:
+        super().__init__(transport=scheduler, **kwargs)
+        self.scheduler = scheduler
+        self.robots = RobotsCache()
+        self.http_cache = HTTPCache()
+
+
+def create_client() -> CrawlClient:
+    """Builds the app-wide pooled HTTP client.
+
+    Limits and timeouts are read from the environment:
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_PER_HOST, HTTP_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY,
+    HTTP_TIMEOUT and HTTP_CONNECT_TIMEOUT. Pacing and retries are set in routers.scheduler."""
+
+    max_connections = int(_env('HTTP_MAX_CONNECTIONS', 100))
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=int(_env('HTTP_MAX_KEEPALIVE', 20)),
+        keepalive_expiry=_env('HTTP_KEEPALIVE_EXPIRY', 30),
+    )
+    timeout = httpx.Timeout(
+        _env('HTTP_TIMEOUT', 10),
+        connect=_env('HTTP_CONNECT_TIMEOUT', 5),
+    )
+    scheduler = Scheduler(
+        per_host=int(_env('HTTP_MAX_PER_HOST', 6)),
+        concurrency=max_connections,
+        limits=limits,
+    )
+
+    return CrawlClient(
+        scheduler,
+        timeout=timeout,
+        follow_redirects=True,
+    )
+
+
+def get_client(request: Request) -> httpx.AsyncClient:
+    """Dependency that hands routers the client opened in the app lifespan."""
+
+    return request.app.state.http_client
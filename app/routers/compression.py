@@ -0,0 +1,36 @@
+"""Gzip compression for responses that are read whole.
+
+Starlette's GZipMiddleware never flushes its compressor between the chunks of a streamed response, so an NDJSON stream
+would reach the client only once it ends. Streams are sent uncompressed instead, every other response larger than
+minimum_size is compressed as before."""
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+
+# Content types written line by line, each line has to reach the client as soon as it is ready
+STREAMED_MEDIA_TYPES = ('application/x-ndjson',)
+
+
+class StreamGZipResponder(GZipResponder):
+    async def send_with_gzip(self, message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            content_type = Headers(raw=message['headers']).get('content-type', '')
+            await super().send_with_gzip(message)
+            # Passed through as they are, the same as responses that are already encoded
+            if content_type.startswith(STREAMED_MEDIA_TYPES):
+                self.content_encoding_set = True
+            return
+
+        await super().send_with_gzip(message)
+
+
+class StreamGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that leaves NDJSON streams uncompressed."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and 'gzip' in Headers(scope=scope).get('Accept-Encoding', ''):
+            responder = StreamGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -0,0 +1,61 @@
+"""Request deadlines.
+
+A caller can give a request a time budget in milliseconds, with the timeout_ms query parameter or the X-Timeout-Ms
+header. It is turned into a deadline in event loop time, which every stage of the request checks and hands down to the
+stages and fetches it starts. A stage that runs out of time stops and the endpoint answers with what it has so far,
+flagged partial, rather than overrunning the caller's budget.
+
+Deadlines are plain loop times (see first_by_priority), None when the caller set no budget."""
+import os
+import asyncio
+from typing import Annotated, Awaitable, TypeVar
+
+from fastapi import Header, Query
+
+
+# Time kept back from every budget to build and send the response
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS') or 50)
+
+T = TypeVar('T')
+
+
+async def get_deadline(
+    timeout_ms: Annotated[int | None, Query(title="Time budget in milliseconds", ge=1)] = None,
+    x_timeout_ms: Annotated[int | None, Header(title="Time budget in milliseconds", ge=1)] = None,
+) -> float | None:
+    """Dependency that turns the caller's time budget into a deadline. The query parameter wins over the header."""
+
+    budget = timeout_ms or x_timeout_ms
+    if budget is None:
+        return None
+
+    # Keep the margin out of the budget, but never all of it
+    budget = max(budget - DEADLINE_MARGIN_MS, budget / 2)
+    return asyncio.get_running_loop().time() + budget / 1000
+
+
+def within(deadline: float | None, seconds: float) -> float:
+    """The deadline of a stage allowed at most seconds, that must also end by the request's deadline."""
+
+    stage = asyncio.get_running_loop().time() + seconds
+    return stage if deadline is None else min(stage, deadline)
+
+
+def remaining(deadline: float | None) -> float | None:
+    """Seconds left until the deadline, never below 0. None when there is no deadline."""
+
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_running_loop().time(), 0)
+
+
+def expired(deadline: float | None) -> bool:
+    return deadline is not None and asyncio.get_running_loop().time() >= deadline
+
+
+async def wait_until(awaitable: Awaitable[T], deadline: float | None) -> T:
+    """Awaits the awaitable, cancelling it and raising TimeoutError if the deadline passes first."""
+
+    if deadline is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, remaining(deadline))
@@ -0,0 +1,122 @@
+"""Error responses.
+
+Every failure is answered with its real HTTP status code and the same JSON body:
+
+    {"status": "failed", "message": "...", "code": 502, "error": "upstream_error", ...}
+
+where error names the kind of failure for clients to branch on and message describes it. Routers raise the APIError
+subclasses below; upstream exceptions that reach the app (timeouts, unreachable hosts, open circuits) are turned into
+them by error_response, registered as the app's exception handler."""
+import math
+import asyncio
+
+import httpx
+from fastapi import Request
+from fastapi.responses import ORJSONResponse
+
+from .breaker import CircuitOpenError
+
+
+class APIError(Exception):
+    """Failure answered with status_code. Extra keyword arguments are added to the body."""
+
+    status_code = 500
+    error = 'server_error'
+    message = 'a server error has occured'
+
+    def __init__(
+            self,
+            message: str | None = None,
+            *,
+            error: str | None = None,
+            status: str = 'failed',
+            headers: dict[str, str] | None = None,
+            **extra
+    ) -> None:
+        self.message = message or self.message
+        self.error = error or self.error
+        self.status = status
+        self.headers = headers
+        self.extra = extra
+        super().__init__(self.message)
+
+    def body(self) -> dict:
+        return {
+            'status': self.status,
+            'message': self.message,
+            'code': self.status_code,
+            'error': self.error,
+            **self.extra
+        }
+
+
+class BadRequest(APIError):
+    status_code = 400
+    error = 'bad_request'
+    message = 'please include a valid url in your request'
+
+    def __init__(self, message: str | None = None, **kwargs) -> None:
+        super().__init__(message, status='bad request', **kwargs)
+
+
+class NotFound(APIError):
+    status_code = 404
+    error = 'not_found'
+    message = 'nothing found'
+
+
+class Conflict(APIError):
+    status_code = 409
+    error = 'conflict'
+    message = 'the request conflicts with the current state'
+
+
+class Unavailable(APIError):
+    status_code = 503
+    error = 'unavailable'
+    message = 'the service is busy, try again later'
+
+
+class Unprocessable(APIError):
+    status_code = 422
+    error = 'unprocessable'
+    message = 'the page could not be analysed'
+
+
+class UpstreamError(APIError):
+    status_code = 502
+    error = 'upstream_error'
+    message = 'the upstream server failed'
+
+
+class UpstreamTimeout(APIError):
+    status_code = 504
+    error = 'upstream_timeout'
+    message = 'the upstream server timed out'
+
+
+class CircuitOpen(APIError):
+    status_code = 503
+    error = 'circuit_open'
+    message = 'the upstream server is failing, try again later'
+
+
+def from_exception(e: Exception) -> APIError:
+    """The APIError to answer an exception with."""
+
+    if isinstance(e, APIError):
+        return e
+    if isinstance(e, CircuitOpenError):
+        return CircuitOpen(detail=str(e), headers={'Retry-After': str(math.ceil(e.retry_after))})
+    if isinstance(e, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return UpstreamTimeout(detail=str(e) or type(e).__name__)
+    if isinstance(e, httpx.HTTPError):
+        return UpstreamError(detail=str(e) or type(e).__name__)
+    return APIError(detail=str(e))
+
+
+async def error_response(request: Request, e: Exception) -> ORJSONResponse:
+    """Exception handler answering APIErrors and upstream exceptions."""
+
+    error = from_exception(e)
+    return ORJSONResponse(error.body(), status_code=error.status_code, headers=error.headers)
@@ -0,0 +1,163 @@
+"""HTTP revalidation cache.
+
+Pages and sitemaps fetched by the crawlers are kept here in their parsed form, along with the validators the server sent
+(ETag, Last-Modified) and how long it said the response stays fresh (Cache-Control max-age). A fresh entry is used
+without any request. A stale one is revalidated with If-None-Match/If-Modified-Since, and a 304 reuses the parsed
+result, skipping both the download and the parse."""
+import os
+import time
+from typing import Any, Callable
+from collections import OrderedDict
+
+import httpx
+
+from .metrics import span
+from .parse_pool import run_parser
+
+
+# Total size of the cached results, counted in items (one per page, one per sitemap entry)
+HTTP_CACHE_MAX_ITEMS = int(os.environ.get('HTTP_CACHE_MAX_ITEMS') or 200000)
+
+
+def freshness(headers: httpx.Headers) -> float | None:
+    """Seconds a response may be used without revalidating it, from its Cache-Control max-age less its Age. Returns
+    None when it must not be stored at all."""
+
+    directives = {}
+    for part in headers.get('cache-control', '').casefold().split(','):
+        name, _, value = part.strip().partition('=')
+        if name:
+            directives[name] = value.strip().strip('"')
+
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives or 'max-age' not in directives:
+        return 0
+
+    try:
+        max_age = float(directives['max-age'])
+        age = float(headers.get('age') or 0)
+    except ValueError:
+        return 0
+
+    return max(max_age - age, 0)
+
+
+class HTTPCache:
+    """Parsed responses keyed by (kind, url), evicted least recently used first once HTTP_CACHE_MAX_ITEMS is passed.
+    Kind tells apart the different parses of the same URL."""
+
+    def __init__(self, max_items: int = HTTP_CACHE_MAX_ITEMS) -> None:
+        self.max_items = max_items
+        self.size = 0
+        # Key: (value, etag, last modified, expires, size)
+        self._entries = OrderedDict()
+        self.fresh_hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def lookup(self, key: tuple[str, str]) -> tuple | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    @staticmethod
+    def is_fresh(entry: tuple) -> bool:
+        return entry[3] > time.time()
+
+    @staticmethod
+    def conditional_headers(entry: tuple | None) -> dict[str, str]:
+        """Request headers that let the server answer 304 when the entry is still current."""
+
+        headers = {}
+        if entry and entry[1]:
+            headers['If-None-Match'] = entry[1]
+        if entry and entry[2]:
+            headers['If-Modified-Since'] = entry[2]
+        return headers
+
+    def store(self, key: tuple[str, str], value: Any, response: httpx.Response, size: int = 1) -> None:
+        """Keeps a parsed 200 response, unless the server forbids it or it could never be reused."""
+
+        fresh = freshness(response.headers)
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if fresh is None or (not fresh and not etag and not last_modified) or size > self.max_items:
+            self._discard(key)
+            return
+
+        self._discard(key)
+        self._entries[key] = (value, etag, last_modified, time.time() + fresh, size)
+        self.size += size
+
+        while self.size > self.max_items:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted[4]
+
+    def refresh(self, key: tuple[str, str], entry: tuple, response: httpx.Response) -> None:
+        """Renews an entry after a 304, taking any new validators and freshness from it."""
+
+        fresh = freshness(response.headers)
+        if fresh is None:
+            self._discard(key)
+            return
+
+        self._entries[key] = (
+            entry[0],
+            response.headers.get('etag') or entry[1],
+            response.headers.get('last-modified') or entry[2],
+            time.time() + fresh,
+            entry[4],
+        )
+
+    def _discard(self, key: tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[4]
+
+
+async def fetch_parsed(
+        url: str,
+        client: httpx.AsyncClient,
+        kind: str,
+        parse: Callable[[bytes], Any],
+        headers: dict[str, str] | None = None,
+) -> tuple[int, Any]:
+    """GETs a URL and parses its body, reusing the client's cached parse while it is fresh or the server answers 304.
+
+    :param url: URL to fetch
+    :param client: Shared HTTP client, its http_cache is used when it has one
+    :param kind: Name of the parse, so different parses of the same URL are cached apart
+    :param parse: Turns the response body into the result, a module level function so large bodies can be parsed on
+        the process pool
+    :param headers: Extra request headers
+
+    Returns the status code and the parsed result, which is None for anything but a 200."""
+
+    cache = getattr(client, 'http_cache', None)
+    key = (kind, url)
+    entry = cache.lookup(key) if cache is not None else None
+
+    if entry is not None and cache.is_fresh(entry):
+        cache.fresh_hits += 1
+        return 200, entry[0]
+
+    with span('fetch'):
+        response = await client.get(url, headers={**(headers or {}), **HTTPCache.conditional_headers(entry)})
+
+    if response.status_code == 304 and entry is not None:
+        cache.revalidated += 1
+        cache.refresh(key, entry, response)
+        return 200, entry[0]
+
+    if response.status_code != 200:
+        return response.status_code, None
+
+    with span('parse'):
+        value = await run_parser(parse, response.content)
+    if cache is not None:
+        cache.misses += 1
+        cache.store(key, value, response)
+
+    return 200, value
@@ -0,0 +1,347 @@
+"""Background jobs router.
+
+Large sites can take longer to crawl than the proxy in front of the API waits for. POST /jobs queues a sitemap or blog
+index run for one or more URLs and returns its ID at once. A pool of in-process workers runs the jobs, and
+GET /jobs/{id} returns the progress and the results finished so far. DELETE /jobs/{id} cancels a job.
+
+The queue is bounded, so jobs are refused with a 503 when it is full. Finished jobs are kept for JOB_TTL seconds. They
+live in memory by default. With JOB_STORE=sqlite they are kept in a local SQLite file instead, so every worker process on
+the machine can report on them (a job can only be cancelled by the process running it)."""
+import os
+import time
+import uuid
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, Any, Literal
+
+import httpx
+import orjson
+from fastapi import APIRouter, Depends, Request
+from pydantic import BaseModel, Field
+
+from .batch import BATCH_CONCURRENCY, BATCH_MAX_URLS, run_batch
+from .cache import ResponseCache
+from .errors import Conflict, NotFound, Unavailable
+from .links import blog_index
+from .sitemap import find_sitemap
+
+# Jobs waiting to start before new ones are refused
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE') or 100)
+
+# Jobs run at the same time
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)
+
+# Seconds a finished job and its results are kept
+JOB_TTL = float(os.environ.get('JOB_TTL') or 3600)
+
+# Seconds between sweeps for expired jobs
+JOB_SWEEP_INTERVAL = 60
+
+# Define API Router
+router = APIRouter(
+    prefix="/jobs",
+    tags=['jobs'],
+)
+
+
+class JobRequest(BaseModel):
+    kind: Literal['sitemap', 'blog_index']
+    urls: list[str] = Field(min_length=1, max_length=BATCH_MAX_URLS)
+    concurrency: int = Field(default=BATCH_CONCURRENCY, ge=1, le=32)
+
+
+class MemoryJobStore:
+    """Jobs kept in this process."""
+
+    def __init__(self) -> None:
+        self._jobs = {}
+
+    async def get(self, job_id: str) -> dict | None:
+        return self._jobs.get(job_id)
+
+    async def put(self, job: dict) -> None:
+        self._jobs[job['id']] = job
+
+    async def put_result(self, job: dict, url: str, result: Any) -> None:
+        # The job dictionary already holds the result
+        self._jobs[job['id']] = job
+
+    async def delete_expired(self, now: float) -> None:
+        for job_id in [job_id for job_id, job in self._jobs.items() if job['expires'] and job['expires'] <= now]:
+            del self._jobs[job_id]
+
+    async def close(self) -> None:
+        self._jobs.clear()
+
+
+class SQLiteJobStore:
+    """Jobs kept in a SQLite file, readable by every worker process on the same machine. Every query runs on one
+    thread, so updates of a job are written in the order they were made.
+
+    The results of a job are rows of their own, so a finished URL writes its result and the job's progress, not every
+    result collected so far."""
+
+    def __init__(self, path: str) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job BLOB NOT NULL, expires REAL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS job_results '
+            '(job_id TEXT NOT NULL, url TEXT NOT NULL, result BLOB NOT NULL, PRIMARY KEY (job_id, url))'
+        )
+
+    def _get(self, job_id: str) -> dict | None:
+        row = self._db.execute('SELECT job FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = orjson.loads(row[0])
+        job['results'] = {
+            url: orjson.loads(result) for url, result in self._db.execute(
+                'SELECT url, result FROM job_results WHERE job_id = ? ORDER BY rowid', (job_id,)
+            )
+        }
+        return job
+
+    def _put(self, job_id: str, blob: bytes, expires: float | None) -> None:
+        self._db.execute('INSERT OR REPLACE INTO jobs (id, job, expires) VALUES (?, ?, ?)', (job_id, blob, expires))
+
+    def _transaction(self, *statements: tuple[str, tuple]) -> None:
+        self._db.execute('BEGIN')
+        try:
+            for query, parameters in statements:
+                self._db.execute(query, parameters)
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _put_result(self, job_id: str, blob: bytes, url: str, result: bytes) -> None:
+        self._transaction(
+            ('INSERT OR REPLACE INTO job_results (job_id, url, result) VALUES (?, ?, ?)', (job_id, url, result)),
+            ('UPDATE jobs SET job = ? WHERE id = ?', (blob, job_id)),
+        )
+
+    def _delete_expired(self, now: float) -> None:
+        self._transaction(
+            ('DELETE FROM job_results WHERE job_id IN (SELECT id FROM jobs WHERE expires <= ?)', (now,)),
+            ('DELETE FROM jobs WHERE expires <= ?', (now,)),
+        )
+
+    async def _call(self, function, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def get(self, job_id: str) -> dict | None:
+        return await self._call(self._get, job_id)
+
+    @staticmethod
+    def _dumps(job: dict) -> bytes:
+        return orjson.dumps({key: value for key, value in job.items() if key != 'results'})
+
+    async def put(self, job: dict) -> None:
+        # Serialized here, the job keeps changing while the write waits for its turn
+        await self._call(self._put, job['id'], self._dumps(job), job['expires'])
+
+    async def put_result(self, job: dict, url: str, result: Any) -> None:
+        """Writes one finished URL's result and the job's progress."""
+
+        await self._call(self._put_result, job['id'], self._dumps(job), url, orjson.dumps(result))
+
+    async def delete_expired(self, now: float) -> None:
+        await self._call(self._delete_expired, now)
+
+    async def close(self) -> None:
+        await self._call(self._db.close)
+        self._executor.shutdown()
+
+
+class JobQueue:
+    """Bounded queue of jobs and the workers running them."""
+
+    def __init__(self, store: MemoryJobStore | SQLiteJobStore, workers: int = JOB_WORKERS) -> None:
+        self.store = store
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+        # Job ID: task, for the jobs running in this process
+        self._running = {}
+        self._tasks = []
+
+    def start(self, client: httpx.AsyncClient, cache: ResponseCache) -> None:
+        """Starts the workers, which run every job with the app's shared client and cache."""
+
+        self._kinds = {
+            'sitemap': lambda url: find_sitemap(url, client, cache),
+            'blog_index': lambda url: blog_index(url, client, cache),
+        }
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def submit(self, request: JobRequest) -> dict:
+        """Queues a job and returns it. Raises Unavailable (503) when the queue is full."""
+
+        urls = list(dict.fromkeys(request.urls))
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': request.kind,
+            'status': 'queued',
+            'urls': urls,
+            'concurrency': request.concurrency,
+            'progress': {'done': 0, 'total': len(urls)},
+            'results': {},
+            'error': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'expires': None,
+        }
+
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise Unavailable('job queue is full, try again later', error='queue_full', headers={'Retry-After': '30'})
+
+        await self.store.put(job)
+        return job
+
+    async def cancel(self, job_id: str) -> dict | None:
+        """Cancels a queued or running job. Finished jobs are left as they are."""
+
+        job = await self.store.get(job_id)
+        if job is None or job['status'] not in ('queued', 'running'):
+            return job
+
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.wait({task})
+            return await self.store.get(job_id)
+
+        if job['status'] == 'running':
+            raise Conflict('job is running in another worker process', error='job_running')
+
+        # Still queued, the worker that takes it will drop it
+        self._finish(job, 'cancelled')
+        await self.store.put(job)
+        return job
+
+    @staticmethod
+    def _finish(job: dict, status: str) -> None:
+        job['status'] = status
+        job['finished'] = time.time()
+        job['expires'] = job['finished'] + JOB_TTL
+
+    async def _run(self, job: dict) -> None:
+        job['status'] = 'running'
+        job['started'] = time.time()
+
+        try:
+            await self.store.put(job)
+            async for url, result in run_batch(job['urls'], self._kinds[job['kind']], job['concurrency']):
+                job['results'][url] = result
+                job['progress']['done'] += 1
+                await self.store.put_result(job, url, result)
+        except asyncio.CancelledError:
+            self._finish(job, 'cancelled')
+        except Exception as e:
+            job['error'] = str(e)
+            self._finish(job, 'failed')
+        else:
+            self._finish(job, 'done')
+
+        await self.store.put(job)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            # Skip jobs cancelled or expired while they waited
+            stored = await self.store.get(job['id'])
+            if stored is None or stored['status'] != 'queued':
+                continue
+
+            task = asyncio.create_task(self._run(job))
+            self._running[job['id']] = task
+            try:
+                # Wait without passing on the job's own cancellation, only the worker's
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            finally:
+                self._running.pop(job['id'], None)
+
+    async def _sweep(self) -> None:
+        while True:
+            await asyncio.sleep(JOB_SWEEP_INTERVAL)
+            try:
+                await self.store.delete_expired(time.time())
+            except Exception:
+                pass
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.store.close()
+
+
+def create_job_queue() -> JobQueue:
+    """Builds the app-wide job queue from the environment: JOB_STORE (memory or sqlite), JOB_STORE_PATH, JOB_WORKERS,
+    JOB_QUEUE_SIZE and JOB_TTL."""
+
+    if (os.environ.get('JOB_STORE') or '').casefold() == 'sqlite':
+        store = SQLiteJobStore(os.environ.get('JOB_STORE_PATH') or 'jobs.sqlite3')
+    else:
+        store = MemoryJobStore()
+
+    return JobQueue(store)
+
+
+def get_jobs(request: Request) -> JobQueue:
+    """Dependency that hands routers the job queue opened in the app lifespan."""
+
+    return request.app.state.jobs
+
+
+def job_status(job: dict) -> dict[str, Any]:
+    """The job as returned to clients, without its input."""
+
+    return {key: value for key, value in job.items() if key not in ('urls', 'concurrency')}
+
+
+"""Path Operations"""
+@router.post("/", status_code=202)
+async def create_job(
+    request: JobRequest,
+    jobs: Annotated[JobQueue, Depends(get_jobs)],
+) -> dict:
+    """Queues /sitemap or /blog-index runs for the given URLs and returns the job ID to poll."""
+
+    job = await jobs.submit(request)
+    return job_status(job)
+
+
+@router.get("/{job_id}")
+async def get_job(
+    job_id: str,
+    jobs: Annotated[JobQueue, Depends(get_jobs)],
+) -> dict:
+    """Returns the job status, its progress and the results of the URLs finished so far."""
+
+    job = await jobs.store.get(job_id)
+    if job is None:
+        raise NotFound('job not found', error='job_not_found')
+    return job_status(job)
+
+
+@router.delete("/{job_id}")
+async def cancel_job(
+    job_id: str,
+    jobs: Annotated[JobQueue, Depends(get_jobs)],
+) -> dict:
+    """Cancels a queued or running job, keeping the results it finished."""
+
+    job = await jobs.cancel(job_id)
+    if job is None:
+        raise NotFound('job not found', error='job_not_found')
+    return job_status(job)
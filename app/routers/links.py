@@ -1,11 +1,22 @@
-import re
-import requests
+import os
+import asyncio
+import httpx
+from typing import Annotated
 from fastapi import Response
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from collections import Counter
+from itertools import zip_longest
+from urllib.parse import urljoin, urlsplit
 
-from fastapi import APIRouter, HTTPException
-import requests.compat
+from fastapi import APIRouter, Depends
+
+from .cache import ResponseCache, get_cache
+from .client import CrawlClient, get_client
+from .deadline import expired, get_deadline, wait_until, within
+from .errors import NotFound, Unprocessable, UpstreamError, UpstreamTimeout
+from .http_cache import fetch_parsed
+from .metrics import span
+from .page_parser import analyze_page, find_recent_posts
+from .utils import first_by_priority
 
 # Define API Router
 router = APIRouter(
@@ -13,148 +24,154 @@ router = APIRouter(
     tags=['blog_index'],
 )
 
-"""Path Operations"""
-@router.get("/", status_code=200)
-async def blog_index(url: str) -> Response:
-    """Refer to order requirements and dms."""
+# Path keywords of a blog index page, and the paths tried when none is linked
+BLOG_KEYWORDS = ('blog', 'news', 'articles')
+BLOG_PATHS = ['blog', 'news', 'articles']
 
-    # URL response object
-    response = requests.get(
-        url=url,
-        headers={
-            'User-Agent': "WriteBolt-API"
-        }
-    )
+# Most candidate blog pages probed for one site
+MAX_BLOG_CANDIDATES = 8
 
-    # Raise HTTP exception if site cannot be reached
-    if response.status_code != 200:
-        raise HTTPException(
-            status_code=response.status_code, 
-            detail="Unable to fetch webpage"
+# Time budget for finding the blog page in seconds, however many candidates there are
+BLOG_PROBE_TIMEOUT = float(os.environ.get('BLOG_PROBE_TIMEOUT') or 10)
+
+
+def blog_candidates(
+        url: str,
+        header_links: list[str],
+        footer_links: list[str],
+        sitemap_result: list | tuple | None = None
+) -> list[str]:
+    """Lists the URLs that may hold the blog index, most likely first:
+    1. Blog links in the header and footer
+    2. The folders holding most blog posts in the sitemap, when /sitemap already crawled the site
+    3. Common blog paths"""
+
+    candidates = []
+
+    for batch in zip_longest(header_links, footer_links):
+        for link in batch:
+            if link and any(keyword in urlsplit(link).path.casefold() for keyword in BLOG_KEYWORDS):
+                candidates.append(urljoin(url, link))
+
+    if sitemap_result and sitemap_result[1]:
+        folders = Counter(
+            urljoin(post, './') for post in sitemap_result[1].get('blogs', [])
         )
+        for folder, _ in folders.most_common(2):
+            if urlsplit(folder).path.strip('/'):
+                candidates.append(folder)
+
+    candidates.extend(urljoin(url, path) for path in BLOG_PATHS)
+
+    return list(dict.fromkeys(candidates))[:MAX_BLOG_CANDIDATES]
 
-    # Get the main article content
-    soup = BeautifulSoup(response.content, "html.parser")
-    main = soup.select_one("div#main") or soup.select_one("div#content")
-    main_pattern = r'(main)|(content)'
-    main = soup.find(
-        lambda tag: (
-            (
-                tag.name == 'div' and 
-                re.search(main_pattern, tag.get('id', ''), re.IGNORECASE) or
-                re.search(main_pattern, ' '.join(tag.get('class', [])), re.IGNORECASE)
-            ) 
-            or
-            tag.name == 'main'
+
+async def probe_blog(blog_url: str, client: httpx.AsyncClient) -> list[str] | None:
+    """Fetches a candidate blog page and returns its 5 most recent posts, or None if it has no post headings or the
+    site's robots.txt (when already known) disallows it."""
+
+    if isinstance(client, CrawlClient):
+        rules = client.robots.peek(blog_url)
+        if rules is not None and not rules.can_fetch(blog_url, "WriteBolt-API"):
+            return None
+
+    try:
+        status, posts = await fetch_parsed(
+            blog_url,
+            client,
+            'blog_posts',
+            find_recent_posts,
+            headers={
+                'User-Agent': "WriteBolt-API"
+            }
         )
-    )
+    except httpx.HTTPError:
+        return None
 
-    # TODO: use first column in case where blog content is split into sidebar and main content
+    # Blog URL cannot be retrived
+    if status != 200:
+        return None
+
+    return posts or None
 
-    links = [
-        a.get('href') 
-        for a in main.find_all("a")
-    ]
+
+"""Path Operations"""
+@router.get("/", status_code=200)
+async def blog_index(
+    url: str,
+    client: Annotated[httpx.AsyncClient, Depends(get_client)],
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    deadline: Annotated[float | None, Depends(get_deadline)] = None,
+) -> Response:
+    """Refer to order requirements and dms.
+
+    With a time budget (timeout_ms or X-Timeout-Ms) the blog page probing stops when it runs out, and the best blog
+    page found by then is returned with partial set. A page without a main content region is answered with a 422
+    (no_main_region)."""
+
+    # Find the main, header and footer regions in one pass over the page, reusing the last parse while the page is
+    # unchanged
+    try:
+        status, page = await wait_until(
+            fetch_parsed(
+                url,
+                client,
+                'page',
+                analyze_page,
+                headers={
+                    'User-Agent': "WriteBolt-API"
+                }
+            ),
+            deadline
+        )
+    except asyncio.TimeoutError:
+        # Nothing to return without the page
+        raise UpstreamTimeout("Unable to fetch webpage in time", error='deadline_exceeded')
+
+    # Raise HTTP exception if site cannot be reached
+    if status in (404, 410):
+        raise NotFound("Unable to fetch webpage", error='page_not_found', upstreamStatus=status)
+    if status != 200:
+        raise UpstreamError("Unable to fetch webpage", upstreamStatus=status)
+
+    # Links and words are only counted in the main region, without one there is no density to judge the page by
+    if not page['found']:
+        raise Unprocessable("The webpage has no main content region", error='no_main_region')
+
+    # TODO: use first column in case where blog content is split into sidebar and main content
 
     # Count links per 1k words
-    word_count = len(main.text.split())
-    links_per_1k_words = (len(links) / word_count) * 1000
+    word_count = page['words']
+    links_per_1k_words = (page['links'] / word_count) * 1000 if word_count else 0
 
     # Equal to 5-6 links per 1k words
     if 5 <= links_per_1k_words <= 6:
         return {'code': 550}
 
     else:
-        # Get first 10 links in header and footer
-        header = soup.find(
-            lambda tag: (
-                tag.name == 'header' or
-
-                tag.name == 'div' and 
-                re.search(r'header', tag.get('id', ''), re.IGNORECASE) or
-                re.search(r'header', ' '.join(tag.get('class', [])), re.IGNORECASE)
-            )
-        )
-        footer = soup.find(
-            lambda tag: (
-                tag.name == 'footer' or
-
-                tag.name == 'div' and 
-                re.search(r'footer', tag.get('id', ''), re.IGNORECASE) or
-                re.search(r'footer', ' '.join(tag.get('class', [])), re.IGNORECASE)
+        # First 15 links in header and footer
+        header_links = page['header_links']
+        footer_links = page['footer_links']
+
+        # Probe every candidate blog page at once, the first one in priority order with post headings wins
+        candidates = blog_candidates(url, header_links, footer_links, await cache.peek('sitemap', url))
+        with span('probe'):
+            found = await first_by_priority(
+                [probe_blog(candidate, client) for candidate in candidates],
+                within(deadline, BLOG_PROBE_TIMEOUT)
             )
-        )
-        if header:  
-            header_links = header.select("a")[:15]
-        if footer:
-            footer_links = footer.select("a")[:15]
-
-        # Blog link and list of blog releases
-        blog_index = []
-        blog_url = ''
-        blog_reached = True
-
-        # Search for blog page link in links from header and footer's first 10 links
-        if header_links or footer_links:
-            for batch in zip(header_links, footer_links):
-                for link in batch:
-                    try:
-                        if 'blog/' in link.get('href'):
-                            blog_url = link.get('href')
-                            break
-                    except AttributeError:
-                        pass
-                if blog_url:
-                    break
-
-        # Form blog URL if not found in header and footer
-        if not blog_url:
-            blog_url = urljoin(url, 'blog')
-
-        # Parse blog page for the 5 most recent blog posts
-        blog_url = urljoin(url, blog_url)
-        blog_res = requests.get(
-            url=blog_url,
-            headers={
-                'User-Agent': "WriteBolt-API"
-            }
-        )
-
-        # Blog URL cannot be retrived
-        if blog_res.status_code != 200:
-            blog_reached = False
+        # The request's budget ran out before every candidate ahead of the one found was probed
+        partial = expired(deadline)
+
+        if found:
+            blog_url = candidates[found[0]]
+            blog_reached = True
+            # 5 most recent blog posts
+            blog_index = found[1]
         else:
-            """Fetch 5 most recent blog posts"""
-            blog_soup = BeautifulSoup(blog_res.content, "html.parser")
-
-            # Get blog titles and parse for the links
-            title_pattern = r'(entry)|(title)'
-            headers = blog_soup.find_all(
-                lambda tag: (
-                    tag.name == 'h3' or
-                    tag.name == 'h6' or
-                    # Other header tags with entry or title in the class name
-                    (
-                        tag.name == 'h2' or
-                        tag.name == 'h4' or 
-                        tag.name == 'h5' 
-                    ) and
-                    re.search(
-                        pattern=title_pattern, 
-                        string=' '.join(tag.get('class', [])), 
-                        flags=re.IGNORECASE
-                    )
-                )
-            )
-            if headers:
-                for header in headers:
-                    anchor = header.select_one('a')
-                    if anchor:
-                        link = anchor.get('href')
-                        blog_index.append(link)
-
-            # Return top 5
-            blog_index = blog_index[:5]
+            blog_url = candidates[0]
+            blog_reached = False
+            blog_index = []
 
         # Less than 5-6 (in which case less than 5 is reasonable)
         if links_per_1k_words < 5:
@@ -163,7 +180,8 @@ async def blog_index(url: str) -> Response:
                 'numLinks': int(links_per_1k_words),
                 'blogURL': blog_url,
                 'blogReached': blog_reached,
-                'blogIndex': blog_index
+                'blogIndex': blog_index,
+                'partial': partial
             }
 
         # More than 5-6, (essentially more than 6)
@@ -173,5 +191,6 @@ async def blog_index(url: str) -> Response:
                 'numLinks': int(links_per_1k_words),
                 'blogURL': blog_url,
                 'blogReached': blog_reached,
-                'blogIndex': blog_index
+                'blogIndex': blog_index,
+                'partial': partial
             }
@@ -0,0 +1,48 @@
+"""Locks per key.
+
+Work done once per host or per site at a time (a robots.txt fetch, a sitemap snapshot update) is serialized with a lock
+for its key. Over a worker's life the keys are every host it has ever crawled, so a lock is only kept while a task holds
+or waits for it."""
+import asyncio
+from typing import Hashable
+
+
+class KeyedLocks:
+    """asyncio.Lock per key, used as `async with locks[key]:`."""
+
+    def __init__(self) -> None:
+        # Key: [lock, tasks holding or waiting for it]
+        self._locks = {}
+
+    def __getitem__(self, key: Hashable) -> '_KeyedLock':
+        return _KeyedLock(self, key)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class _KeyedLock:
+    def __init__(self, locks: KeyedLocks, key: Hashable) -> None:
+        self._locks = locks._locks
+        self._key = key
+
+    async def __aenter__(self) -> None:
+        entry = self._locks.get(self._key)
+        if entry is None:
+            entry = self._locks[self._key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._leave(entry)
+            raise
+
+    async def __aexit__(self, *exc_info) -> None:
+        entry = self._locks[self._key]
+        entry[0].release()
+        self._leave(entry)
+
+    def _leave(self, entry: list) -> None:
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[self._key]
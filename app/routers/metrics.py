@@ -0,0 +1,223 @@
+"""Request metrics and the /metrics endpoint.
+
+Counters, gauges and histograms are kept in this process and rendered in the Prometheus text format on GET /metrics:
+- request latency, counts and in-flight requests per route, recorded by MetricsMiddleware
+- upstream latency, errors and bytes downloaded per host, recorded by the outbound scheduler
+- which upstream circuits are open, set by routers.breaker
+- time spent in each stage of a request (fetch, parse, classify, reorder ...), recorded with span()
+- hit ratios of the response cache and the HTTP revalidation cache, read when scraped
+
+Upstream hosts are unbounded, so only the first METRICS_MAX_HOSTS get their own label, the rest are counted as 'other'."""
+import os
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Iterator
+
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+
+METRICS_MAX_HOSTS = int(os.environ.get('METRICS_MAX_HOSTS') or 200)
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+router = APIRouter(
+    tags=['metrics'],
+)
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in self.values.items():
+            lines.append(f'{self.name}{_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, *labels, value: float) -> None:
+        self.values[labels] = value
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Labels: [count per bucket (+Inf last), sum]
+        self.values = {}
+
+    def observe(self, *labels, value: float) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _labels(self.labels + ('le',), labels + (bound,))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+REQUESTS = Counter('http_requests_total', 'Requests served.', ('route', 'method', 'status'))
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time to serve a request.', ('route',))
+IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being served.', ('route',))
+
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_duration_seconds', 'Time until upstream response headers arrived.', ('host',)
+)
+UPSTREAM_ERRORS = Counter('upstream_errors_total', 'Failed upstream requests.', ('host', 'reason'))
+UPSTREAM_BYTES = Counter('upstream_bytes_total', 'Response body bytes downloaded from upstream.', ('host',))
+CIRCUIT_OPEN = Gauge('circuit_open', 'Whether the circuit of an upstream is open (1) or closed (0).', ('upstream',))
+
+STAGE_LATENCY = Histogram('stage_duration_seconds', 'Time spent in each stage of a request.', ('stage',))
+
+CACHE_REQUESTS = Gauge('cache_requests', 'Cache lookups since startup.', ('cache', 'namespace', 'result'))
+CACHE_HIT_RATIO = Gauge('cache_hit_ratio', 'Share of cache lookups answered from the cache.', ('cache', 'namespace'))
+
+METRICS = [
+    REQUESTS, REQUEST_LATENCY, IN_FLIGHT, UPSTREAM_LATENCY, UPSTREAM_ERRORS, UPSTREAM_BYTES, CIRCUIT_OPEN,
+    STAGE_LATENCY, CACHE_REQUESTS, CACHE_HIT_RATIO,
+]
+
+_hosts = set()
+
+
+def host_label(host: str) -> str:
+    """Returns the host as a label value, or 'other' once METRICS_MAX_HOSTS hosts have their own label."""
+
+    if host in _hosts:
+        return host
+    if len(_hosts) < METRICS_MAX_HOSTS:
+        _hosts.add(host)
+        return host
+    return 'other'
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Records the time spent in the with block as the given stage."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(stage, value=time.perf_counter() - start)
+
+
+def _prefix(path: str) -> str:
+    return '/' + path.strip('/').split('/', 1)[0]
+
+
+class MetricsMiddleware:
+    """Times every HTTP request, labelled by the route it matched rather than its path."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self._prefixes = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        # The route is only known once the router has matched it, count in-flight requests by path prefix until then
+        if self._prefixes is None:
+            self._prefixes = {_prefix(route.path) for route in scope['app'].routes}
+        prefix = _prefix(scope['path'])
+        if prefix not in self._prefixes:
+            prefix = 'other'
+        IN_FLIGHT.inc(prefix)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            IN_FLIGHT.dec(prefix)
+            route = scope.get('route')
+            route = route.path if route is not None else 'unmatched'
+            REQUESTS.inc(route, scope['method'], status)
+            REQUEST_LATENCY.observe(route, value=time.perf_counter() - start)
+
+
+def collect_caches(request: Request) -> None:
+    """Copies the cache counters of the app into the cache gauges."""
+
+    cache = getattr(request.app.state, 'cache', None)
+    if cache is not None:
+        for namespace, counts in cache.stats().items():
+            hits = counts['hits'] + counts['coalesced']
+            for result, value in counts.items():
+                CACHE_REQUESTS.set('response', namespace, result, value=value)
+            lookups = hits + counts['misses']
+            CACHE_HIT_RATIO.set('response', namespace, value=hits / lookups if lookups else 0)
+
+    http_cache = getattr(getattr(request.app.state, 'http_client', None), 'http_cache', None)
+    if http_cache is not None:
+        counts = {
+            'fresh_hits': http_cache.fresh_hits,
+            'revalidated': http_cache.revalidated,
+            'misses': http_cache.misses,
+        }
+        for result, value in counts.items():
+            CACHE_REQUESTS.set('http', 'all', result, value=value)
+        lookups = sum(counts.values())
+        hits = counts['fresh_hits'] + counts['revalidated']
+        CACHE_HIT_RATIO.set('http', 'all', value=hits / lookups if lookups else 0)
+
+
+"""Path Operations"""
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request) -> PlainTextResponse:
+    """Every metric of this process in the Prometheus text format."""
+
+    collect_caches(request)
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    return PlainTextResponse('\n'.join(lines) + '\n', media_type='text/plain; version=0.0.4')
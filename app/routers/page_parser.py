@@ -0,0 +1,219 @@
+"""HTML page analysis for the blog index router.
+
+Pages are parsed with lxml and walked once, collecting everything the router needs on the way instead of searching the
+tree again for every region."""
+import re
+from datetime import datetime, timezone
+
+from lxml import etree, html
+
+
+MAIN_PATTERN = re.compile(r'(main)|(content)', re.IGNORECASE)
+HEADER_PATTERN = re.compile(r'header', re.IGNORECASE)
+FOOTER_PATTERN = re.compile(r'footer', re.IGNORECASE)
+TITLE_PATTERN = re.compile(r'(entry)|(title)', re.IGNORECASE)
+
+# Tags whose contents are not counted as words (same as BeautifulSoup's .text)
+NON_TEXT_TAGS = {'script', 'style', 'template'}
+
+# Number of header and footer links kept
+REGION_LINKS = 15
+
+# Levels above a post heading searched for its publish date
+POST_DATE_DEPTH = 3
+DATE_XPATH = './/time | .//*[@itemprop="datePublished"]'
+HEADINGS_XPATH = './/h2 | .//h3 | .//h4 | .//h5 | .//h6'
+
+
+def parse_html(content: bytes) -> html.HtmlElement | None:
+    """Parses a page, returning None when there is nothing to parse."""
+
+    try:
+        root = html.document_fromstring(content)
+    except (etree.ParserError, ValueError):
+        return None
+
+    # Merge comment tails into the surrounding text so the walk below sees all of it
+    etree.strip_tags(root, etree.Comment, etree.ProcessingInstruction)
+    return root
+
+
+def is_main(element: html.HtmlElement) -> bool:
+    tag = element.tag
+    return (
+        tag == 'div' and MAIN_PATTERN.search(element.get('id', '')) is not None or
+        MAIN_PATTERN.search(element.get('class', '')) is not None or
+        tag == 'main'
+    )
+
+
+def is_header(element: html.HtmlElement) -> bool:
+    tag = element.tag
+    return (
+        tag == 'header' or
+        tag == 'div' and HEADER_PATTERN.search(element.get('id', '')) is not None or
+        HEADER_PATTERN.search(element.get('class', '')) is not None
+    )
+
+
+def is_footer(element: html.HtmlElement) -> bool:
+    tag = element.tag
+    return (
+        tag == 'footer' or
+        tag == 'div' and FOOTER_PATTERN.search(element.get('id', '')) is not None or
+        FOOTER_PATTERN.search(element.get('class', '')) is not None
+    )
+
+
+def analyze_page(content: bytes) -> dict:
+    """Finds the main, header and footer regions of a page in a single walk over the tree.
+
+    Returns a dict with:
+    - found: whether a main region exists
+    - links: number of links in the main region
+    - words: number of words in the main region
+    - header_links, footer_links: hrefs of the first 15 links in the header and footer"""
+
+    result = {
+        'found': False,
+        'links': 0,
+        'words': 0,
+        'header_links': [],
+        'footer_links': [],
+    }
+
+    root = parse_html(content)
+    if root is None:
+        return result
+
+    main = header = footer = None
+    in_main = in_header = in_footer = False
+    header_count = footer_count = 0
+    text = []
+
+    for event, element in etree.iterwalk(root, events=('start', 'end')):
+        tag = element.tag
+
+        if event == 'start':
+            # Regions are the first element matching, in document order
+            if main is None and is_main(element):
+                main = element
+                in_main = True
+            if header is None and is_header(element):
+                header = element
+                in_header = True
+            if footer is None and is_footer(element):
+                footer = element
+                in_footer = True
+
+            if in_main:
+                if tag == 'a':
+                    result['links'] += 1
+                if element.text and tag not in NON_TEXT_TAGS:
+                    text.append(element.text)
+
+            if tag == 'a':
+                href = element.get('href')
+                if in_header and header_count < REGION_LINKS:
+                    header_count += 1
+                    if href is not None:
+                        result['header_links'].append(href)
+                if in_footer and footer_count < REGION_LINKS:
+                    footer_count += 1
+                    if href is not None:
+                        result['footer_links'].append(href)
+
+        else:
+            if element is main:
+                in_main = False
+            elif in_main and element.tail:
+                text.append(element.tail)
+            if element is header:
+                in_header = False
+            if element is footer:
+                in_footer = False
+
+    result['found'] = main is not None
+    result['words'] = len(''.join(text).split())
+    return result
+
+
+def is_post_heading(element: html.HtmlElement) -> bool:
+    tag = element.tag
+    return (
+        tag == 'h3' or
+        tag == 'h6' or
+        # Other header tags with entry or title in the class name
+        tag in ('h2', 'h4', 'h5') and TITLE_PATTERN.search(element.get('class', '')) is not None
+    )
+
+
+def post_date(heading: html.HtmlElement) -> datetime | None:
+    """Finds the publish date of a post from the <time> or datePublished metadata closest to its heading.
+
+    Looks through the heading's ancestors, stopping at the first one that also holds another post's heading."""
+
+    element = heading
+    for _ in range(POST_DATE_DEPTH):
+        for node in element.xpath(DATE_XPATH):
+            value = node.get('datetime') or node.get('content') or node.text_content()
+            date = parse_date(value)
+            if date is not None:
+                return date
+
+        element = element.getparent()
+        if element is None or len(element.xpath(HEADINGS_XPATH)) > 1:
+            return None
+
+    return None
+
+
+def parse_date(value: str | None) -> datetime | None:
+    """Reads an ISO 8601 date, as naive UTC so every date can be compared."""
+
+    if not value:
+        return None
+    try:
+        date = datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def extract_posts(content: bytes) -> list[tuple[str, datetime | None]]:
+    """Returns the link and publish date (if the page has one) of every blog post heading on a blog index page, in
+    document order."""
+
+    root = parse_html(content)
+    if root is None:
+        return []
+
+    posts = []
+    for heading in root.iter('h2', 'h3', 'h4', 'h5', 'h6'):
+        if not is_post_heading(heading):
+            continue
+        anchor = next(heading.iter('a'), None)
+        if anchor is not None and anchor.get('href') is not None:
+            posts.append((anchor.get('href'), post_date(heading)))
+
+    return posts
+
+
+def recent_posts(posts: list[tuple[str, datetime | None]], count: int = 5) -> list[str]:
+    """Returns the links of the most recent posts. Dated posts come newest first, followed by undated posts in document
+    order."""
+
+    dated = sorted((post for post in posts if post[1] is not None), key=lambda post: post[1], reverse=True)
+    undated = [post for post in posts if post[1] is None]
+
+    # Remove duplicates, a post is often linked from its title and its image
+    links = dict.fromkeys(link for link, _ in dated + undated)
+    return list(links)[:count]
+
+
+def find_recent_posts(content: bytes, count: int = 5) -> list[str]:
+    """Returns the links of the most recent posts on a blog index page."""
+
+    return recent_posts(extract_posts(content), count)
@@ -0,0 +1,55 @@
+"""Process pool for CPU-heavy parsing.
+
+Parsing a large HTML page holds the GIL for as long as it takes, stalling every other request on the worker. Documents
+of PARSE_INLINE_BYTES or more are parsed on a pool of PARSE_WORKERS processes instead: the raw bytes go to the pool and
+only the parser's compact result comes back. Smaller documents are parsed inline, where sending them to another process
+would cost more than the parse. PARSE_WORKERS=0 parses everything inline."""
+import os
+import asyncio
+import multiprocessing
+from typing import Callable, TypeVar
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS') or min(os.cpu_count() or 1, 4))
+
+# Documents smaller than this are parsed on the event loop
+PARSE_INLINE_BYTES = int(os.environ.get('PARSE_INLINE_BYTES') or 256 * 1024)
+
+T = TypeVar('T')
+
+# Created on first use, so processes that never parse a large document never start one
+_executor = None
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Spawned rather than forked, forking a process that runs threads can deadlock the child
+        _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+async def run_parser(parse: Callable[[bytes], T], content: bytes) -> T:
+    """Runs parse(content), on the process pool when the document is large.
+
+    :param parse: Module level function (or partial of one), so it can be sent to the pool
+    :param content: Raw document bytes"""
+
+    if PARSE_WORKERS <= 0 or len(content) < PARSE_INLINE_BYTES:
+        return parse(content)
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool(), parse, content)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory), start a new pool next time and parse this one here
+        shutdown()
+        return parse(content)
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,200 @@
+"""robots.txt parsing and caching.
+
+Every host's robots.txt is downloaded and parsed once into a RobotsRules object (sitemaps, allow/disallow rules and
+crawl delays per user agent), then kept for ROBOTS_TTL seconds. After that it is revalidated with its ETag or
+Last-Modified validators, so an unchanged file costs a 304 and no parse."""
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlsplit
+
+import httpx
+
+from .locks import KeyedLocks
+
+
+# Seconds a parsed robots.txt is used before it is revalidated
+ROBOTS_TTL = float(os.environ.get('ROBOTS_TTL') or 3600)
+
+# Seconds before retrying a host whose robots.txt could not be reached
+ROBOTS_ERROR_TTL = 60
+
+# Hosts whose rules are kept, the least recently used are dropped first and fetched again when needed
+ROBOTS_MAX_HOSTS = int(os.environ.get('ROBOTS_MAX_HOSTS') or 2000)
+
+USER_AGENT = 'ResearchEngine'
+
+
+def _compile_rule(path: str) -> re.Pattern:
+    """Turns a robots.txt path pattern (with * wildcards and an optional $ end anchor) into a regex."""
+
+    anchored = path.endswith('$')
+    if anchored:
+        path = path[:-1]
+    pattern = '.*'.join(re.escape(part) for part in path.split('*'))
+    return re.compile(pattern + ('$' if anchored else ''))
+
+
+class RobotsRules:
+    """Parsed contents of a robots.txt file."""
+
+    def __init__(self, text: str = '') -> None:
+        self.sitemaps = []
+        # User agent: list of (allow, length, regex) rules
+        self.rules = defaultdict(list)
+        # User agent: crawl delay in seconds
+        self.delays = {}
+
+        agents = []
+        in_agents = False
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            name, separator, value = line.partition(':')
+            name = name.strip().casefold()
+            value = value.strip()
+            if not name or not separator:
+                continue
+
+            if name == 'user-agent':
+                # Consecutive user-agent lines share the group that follows them
+                if not in_agents:
+                    agents = []
+                agents.append(value.casefold())
+                in_agents = True
+                continue
+            in_agents = False
+
+            if name == 'sitemap':
+                if value:
+                    self.sitemaps.append(value)
+
+            elif name in ('allow', 'disallow'):
+                # An empty disallow allows everything, it adds no rule
+                if value:
+                    rule = (name == 'allow', len(value), _compile_rule(value))
+                    for agent in agents:
+                        self.rules[agent].append(rule)
+
+            elif name == 'crawl-delay':
+                try:
+                    delay = float(value)
+                except ValueError:
+                    continue
+                for agent in agents:
+                    self.delays[agent] = delay
+
+        # Remove duplicates, keeping the order they were listed in
+        self.sitemaps = list(dict.fromkeys(self.sitemaps))
+
+    def _agent(self, user_agent: str, table: dict) -> str | None:
+        """Returns the most specific agent of the table that applies to the user agent, falling back to *."""
+
+        user_agent = user_agent.casefold()
+        matches = [agent for agent in table if agent != '*' and agent in user_agent]
+        if matches:
+            return max(matches, key=len)
+        return '*' if '*' in table else None
+
+    def can_fetch(self, url: str, user_agent: str = USER_AGENT) -> bool:
+        """Whether the user agent may fetch the URL. The longest matching rule wins, allow wins a tie."""
+
+        agent = self._agent(user_agent, self.rules)
+        if agent is None:
+            return True
+
+        parts = urlsplit(url)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        if path == '/robots.txt':
+            return True
+
+        best = None
+        for allow, length, regex in self.rules[agent]:
+            if regex.match(path) and (best is None or length > best[1] or length == best[1] and allow):
+                best = (allow, length)
+
+        return best is None or best[0]
+
+    def crawl_delay(self, user_agent: str = USER_AGENT) -> float | None:
+        agent = self._agent(user_agent, self.delays)
+        return self.delays.get(agent) if agent else None
+
+
+class RobotsCache:
+    """robots.txt rules per host, fetched once and revalidated after ROBOTS_TTL seconds. At most max_hosts hosts are
+    kept."""
+
+    def __init__(self, max_hosts: int = ROBOTS_MAX_HOSTS) -> None:
+        self.max_hosts = max_hosts
+        # Origin: (rules, etag, last modified, expires)
+        self._entries = OrderedDict()
+        self._locks = KeyedLocks()
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}'
+
+    def peek(self, url: str) -> RobotsRules | None:
+        """Returns the rules for the URL's host if they were fetched already, without any network call."""
+
+        entry = self._entries.get(self._origin(url))
+        return entry[0] if entry else None
+
+    async def get(self, url: str, client: httpx.AsyncClient) -> RobotsRules:
+        """Returns the rules for the URL's host, fetching or revalidating robots.txt when needed.
+
+        Missing files allow everything. Unreachable files allow everything until they are tried again a minute later."""
+
+        origin = self._origin(url)
+        entry = self._entries.get(origin)
+        if entry and entry[3] > time.time():
+            self._entries.move_to_end(origin)
+            return entry[0]
+
+        # One fetch per host at a time, the rest wait for its result
+        async with self._locks[origin]:
+            entry = self._entries.get(origin)
+            if entry and entry[3] > time.time():
+                return entry[0]
+
+            headers = {'User-Agent': USER_AGENT}
+            if entry and entry[1]:
+                headers['If-None-Match'] = entry[1]
+            if entry and entry[2]:
+                headers['If-Modified-Since'] = entry[2]
+
+            try:
+                response = await client.get(f'{origin}/robots.txt', headers=headers)
+            except httpx.HTTPError:
+                rules = entry[0] if entry else RobotsRules()
+                self._store(origin, (rules, None, None, time.time() + ROBOTS_ERROR_TTL))
+                return rules
+
+            if response.status_code == 304 and entry:
+                rules = entry[0]
+                ttl = ROBOTS_TTL
+            elif response.status_code == 200:
+                rules = RobotsRules(response.text)
+                ttl = ROBOTS_TTL
+            elif 400 <= response.status_code < 500:
+                rules = RobotsRules()
+                ttl = ROBOTS_TTL
+            else:
+                rules = entry[0] if entry else RobotsRules()
+                ttl = ROBOTS_ERROR_TTL
+
+            # A 304 may leave out the validators, keep the old ones then
+            self._store(origin, (
+                rules,
+                response.headers.get('etag') or (entry[1] if entry else None),
+                response.headers.get('last-modified') or (entry[2] if entry else None),
+                time.time() + ttl,
+            ))
+            return rules
+
+    def _store(self, origin: str, entry: tuple) -> None:
+        self._entries[origin] = entry
+        self._entries.move_to_end(origin)
+        while len(self._entries) > self.max_hosts:
+            self._entries.popitem(last=False)
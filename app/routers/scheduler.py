@@ -0,0 +1,304 @@
+"""Outbound request scheduler.
+
+Every request made with the shared HTTP client passes through the Scheduler transport, which keeps the crawlers polite:
+- a token bucket per host paces requests, slowed further by a robots.txt Crawl-delay
+- open requests are capped per host and overall
+- 429 and 503 responses are retried after their Retry-After delay (or an exponential backoff), and the host is paused
+  for every other request in the meantime
+- a host whose requests keep failing (errors, timeouts, 5xx) has its circuit opened, see routers.breaker
+Upstream latency, errors and bytes downloaded per host are recorded in routers.metrics.
+
+The state of at most HTTP_MAX_HOSTS hosts is kept. Past that, the least recently used hosts that are idle (no request
+open or waiting, no pause, and a closed circuit with no failures counted) are forgotten."""
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Callable
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from .breaker import CircuitBreaker
+from .metrics import UPSTREAM_BYTES, UPSTREAM_ERRORS, UPSTREAM_LATENCY, host_label
+
+
+def _env(name: str, default: float) -> float:
+    """Reads a numeric setting from the environment, falling back to the default."""
+
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+# Requests per second and burst size allowed per host
+HOST_RATE = _env('HTTP_HOST_RATE', 10)
+HOST_BURST = _env('HTTP_HOST_BURST', 10)
+
+# Retries of a throttled request, and the longest wait before one
+MAX_RETRIES = int(_env('HTTP_MAX_RETRIES', 2))
+MAX_RETRY_WAIT = _env('HTTP_MAX_RETRY_WAIT', 30)
+
+# Statuses that mean "slow down"
+THROTTLE_STATUSES = {429, 503}
+
+# Hosts whose pacing, request slots and circuit are kept
+MAX_HOSTS = int(_env('HTTP_MAX_HOSTS', 2000))
+
+
+class TokenBucket:
+    """Lets rate requests through per second on average, with bursts of up to burst requests. Waiters are served in
+    order."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def pause(self, seconds: float) -> None:
+        """Holds every request back for the given number of seconds."""
+
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        """Whether nobody waits for a token and the bucket has refilled, so a new bucket would behave the same."""
+
+        now = time.monotonic()
+        return (
+            not self._lock.locked() and
+            now >= self.paused_until and
+            self.tokens + (now - self.updated) * self.rate >= self.burst
+        )
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def retry_after(response: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before retrying a throttled response, from its Retry-After header (seconds or HTTP date) or an
+    exponential backoff."""
+
+    value = response.headers.get('retry-after', '').strip()
+    wait = None
+    if value.isdigit():
+        wait = float(value)
+    elif value:
+        try:
+            wait = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            wait = None
+
+    if wait is None:
+        wait = 2 ** attempt
+
+    return min(max(wait, 0), MAX_RETRY_WAIT)
+
+
+class HostSlots:
+    """Request slots and token bucket of one host."""
+
+    def __init__(self, per_host: int, rate: float, burst: float) -> None:
+        self.semaphore = asyncio.Semaphore(per_host)
+        self.bucket = TokenBucket(rate, burst)
+        # Requests holding a slot or waiting for one
+        self.active = 0
+
+    async def acquire(self) -> None:
+        self.active += 1
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.active -= 1
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        self.semaphore.release()
+
+    def idle(self) -> bool:
+        return not self.active and self.bucket.idle()
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Response stream that frees its request slots once the body has been closed, and counts the bytes read."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, semaphores: list, host: str) -> None:
+        self._stream = stream
+        self._semaphores = semaphores
+        self._host = host
+        self._bytes = 0
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._bytes += len(chunk)
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                UPSTREAM_BYTES.inc(self._host, amount=self._bytes)
+                for semaphore in self._semaphores:
+                    semaphore.release()
+
+
+class Scheduler(httpx.AsyncBaseTransport):
+    """Pooled transport that paces, caps and retries requests per host."""
+
+    def __init__(
+            self,
+            per_host: int,
+            concurrency: int,
+            rate: float = HOST_RATE,
+            burst: float = HOST_BURST,
+            max_hosts: int = MAX_HOSTS,
+            **kwargs
+    ) -> None:
+        self._transport = httpx.AsyncHTTPTransport(**kwargs)
+        self._global = asyncio.Semaphore(concurrency)
+        # Host: HostSlots, and host and port: CircuitBreaker, least recently used first
+        self._hosts = OrderedDict()
+        self._breakers = OrderedDict()
+        self.per_host = per_host
+        self.rate = rate
+        self.burst = burst
+        self.max_hosts = max_hosts
+
+    def _make_room(self, entries: OrderedDict, idle: Callable[[Any], bool]) -> None:
+        """Drops the least recently used idle entries until one more fits in max_hosts. Busy ones are kept, and
+        dropped once they are idle and first in line again."""
+
+        excess = len(entries) + 1 - self.max_hosts
+        evict = []
+        for key, value in entries.items():
+            if len(evict) >= excess:
+                break
+            if idle(value):
+                evict.append(key)
+        for key in evict:
+            del entries[key]
+
+    def host(self, host: str) -> HostSlots:
+        """The request slots and token bucket of a host."""
+
+        slots = self._hosts.get(host)
+        if slots is None:
+            self._make_room(self._hosts, HostSlots.idle)
+            slots = self._hosts[host] = HostSlots(self.per_host, self.rate, self.burst)
+        else:
+            self._hosts.move_to_end(host)
+        return slots
+
+    def set_crawl_delay(self, host: str, delay: float) -> None:
+        """Spaces requests to the host at least delay seconds apart, as asked by its robots.txt."""
+
+        if delay > 0:
+            self.host(host).bucket.set_rate(min(self.rate, 1 / delay), 1)
+
+    def breaker(self, origin: str, host: str) -> CircuitBreaker:
+        """The circuit breaker of a host and port."""
+
+        breaker = self._breakers.get(origin)
+        if breaker is None:
+            # A breaker counting failures or open is kept, forgetting it would let a failing host be called again
+            self._make_room(self._breakers, lambda breaker: not breaker.failures and breaker.opened_at is None)
+            breaker = self._breakers[origin] = CircuitBreaker(origin, host_label(host))
+        else:
+            self._breakers.move_to_end(origin)
+        return breaker
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        """Sends one request once its host and the pool have room, holding the slots until the body is closed. Fails at
+        once while the host's circuit is open."""
+
+        host = request.url.host
+        breaker = self.breaker(request.url.netloc.decode('ascii'), host)
+        breaker.check(request)
+        slots = self.host(host)
+        semaphores = [slots, self._global]
+
+        # Wait for the host first so a busy host does not hold a pool slot
+        try:
+            await semaphores[0].acquire()
+        except BaseException:
+            breaker.release()
+            raise
+        try:
+            await slots.bucket.acquire()
+            await semaphores[1].acquire()
+        except BaseException:
+            semaphores[0].release()
+            breaker.release()
+            raise
+
+        label = host_label(host)
+        start = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException as e:
+            for semaphore in semaphores:
+                semaphore.release()
+            if isinstance(e, Exception):
+                UPSTREAM_ERRORS.inc(label, type(e).__name__)
+                breaker.failure()
+            else:
+                breaker.release()
+            raise
+
+        UPSTREAM_LATENCY.observe(label, value=time.perf_counter() - start)
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(label, str(response.status_code))
+        # Any answer short of a server error shows the host is up, throttling is handled by the retries instead
+        if response.status_code in THROTTLE_STATUSES:
+            breaker.release()
+        elif response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+
+        response.stream = _ReleasingStream(response.stream, semaphores, label)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            response = await self._send(request)
+            if (
+                response.status_code not in THROTTLE_STATUSES or
+                attempt >= MAX_RETRIES or
+                # Only requests without a body can be sent again
+                request.method not in ('GET', 'HEAD')
+            ):
+                return response
+
+            # Throttled, pause the host for everyone and try again
+            wait = retry_after(response, attempt)
+            await response.aclose()
+            self.host(request.url.host).bucket.pause(wait)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
@@ -1,10 +1,15 @@
 """Programmable search engine router."""
 import os
-import requests
+import asyncio
+import httpx
 from typing import Any, Annotated
 
-from fastapi import APIRouter, Query, Response
+from fastapi import APIRouter, Depends, Query, Response
 
+from .cache import ResponseCache, get_cache
+from .client import get_client
+from .errors import UpstreamError
+from .metrics import span
 from .utils import (
     reorder,
     remove_keys,
@@ -19,12 +24,72 @@ router = APIRouter(
     }
 )
 
+# Google CSE returns 10 results per page and at most 100 in total
+PAGE_SIZE = 10
+MAX_RESULTS = 100
+
+# Google API endpoint, overridable to point at a stand-in server
+GSE_ENDPOINT = os.environ.get('GSE_ENDPOINT') or 'https://customsearch.googleapis.com/customsearch/v1'
+
+# Seconds allowed for one page of results, shorter than the client's timeout for crawled sites
+CSE_TIMEOUT = float(os.environ.get('CSE_TIMEOUT') or 5)
+
+
+async def fetch_page(
+        client: httpx.AsyncClient,
+        api_key: str,
+        engine_id: str,
+        q: str,
+        start: int
+) -> tuple[int, dict]:
+    """Fetches one page of search results starting at the given index. Returns the status code and the response data."""
+
+    endpoint = f"{GSE_ENDPOINT}?key={api_key}&cx={engine_id}&q={q}&num={PAGE_SIZE}&start={start}"
+
+    response = await client.get(endpoint, timeout=CSE_TIMEOUT)
+    try:
+        return response.status_code, dict(response.json())
+    except ValueError:
+        # Error pages from a proxy or load balancer are not JSON
+        return response.status_code, {}
+
+
 """Path Operations"""
 @router.get("/", status_code=200, response_model=dict[str, Any])
 async def search(
-    q: Annotated[str, Query(title="Search query", min_length=1)]
+    q: Annotated[str, Query(title="Search query", min_length=1)],
+    client: Annotated[httpx.AsyncClient, Depends(get_client)],
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    search_limit: Annotated[int, Query(title="Number of results", ge=1, le=MAX_RESULTS)] = 30,
 ) -> Response:
-    """Google custom search engine API (and others to be added later on)"""
+    """Google custom search engine API (and others to be added later on)
+    
+    Results are cached per query and limit. Answers 502 when the search API fails, 504 when it times out and 503 while
+    its circuit is open."""
+
+    result = await cache.get_or_fetch(
+        'search',
+        f'{search_limit}:{q}',
+        lambda: run_search(q, client, search_limit),
+        is_empty=lambda result: result['status'] == 'empty',
+        is_failure=lambda result: result['status'] == 'failed',
+    )
+
+    if result['status'] == 'failed':
+        raise UpstreamError(
+            'the search API failed',
+            error='search_failed',
+            upstreamStatus=result.get('code'),
+            data=result['data']
+        )
+
+    return result
+
+
+async def run_search(q: str, client: httpx.AsyncClient, search_limit: int) -> dict[str, Any]:
+    """Queries Google CSE for up to search_limit results.
+    
+    All result pages are requested at once and merged in order. Pages after one that comes back empty are cancelled."""
 
     q = q.replace(" ", "+")
 
@@ -41,40 +106,45 @@ async def search(
         'kind',
     ]
 
-    # Search limit
-    search_limit = 30
-    limit_temp = search_limit
-
-    # Start index for page results at 10 per page
-    page_index = 1
-
-    # Page count tracker
-    count = 1
-    while limit_temp > 0:
-        # Google API endpoint
-        endpoint = f"https://customsearch.googleapis.com/customsearch/v1?key={api_key}&cx={engine_id}&q={q}&num=10&start={page_index}"
+    # Start index of every page needed, at 10 per page
+    starts = range(1, search_limit + 1, PAGE_SIZE)
+    tasks = [
+        asyncio.create_task(fetch_page(client, api_key, engine_id, q, start))
+        for start in starts
+    ]
 
-        # Query API for search results
-        response = requests.get(endpoint)
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                code, search_results = task.result()
+                # No more results past an empty page, drop the pages after it
+                if code == 200 and not search_results.get('items'):
+                    for later in tasks[tasks.index(task) + 1:]:
+                        later.cancel()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    # Merge pages in order
+    for task in tasks:
+        if task.cancelled():
+            break
 
-        if response.status_code != 200:
-            response_data = response.json()
+        code, search_results = task.result()
+        if code != 200:
             return {
                 'status': 'failed',
-                'data': response_data
+                'code': code,
+                'data': search_results
             }
 
-        search_results = dict(response.json())
-
         if items:=search_results.get('items'):
             # Add to complete list
             complete_results.extend(items)
-
-            # Move to next page (next 10 results)
-            page_index += 10
-            limit_temp -= 10
-            count += 1
-            continue
         else:
             # Break search when there are no/no more results
             break
@@ -91,7 +161,8 @@ async def search(
     remove_keys(complete_results, remove_list)
 
     # Rearrange results to remove duplicates in every 10 blocks
-    complete_results = reorder(complete_results[:search_limit])
+    with span('reorder'):
+        complete_results = reorder(complete_results[:search_limit])
     return {
         'status': 'success',
         'resultsCount': f'{len(complete_results)}',
@@ -1,69 +1,215 @@
 """Sitemaps router."""
-from fastapi import APIRouter, Query
+import httpx
+import orjson
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from typing import Annotated
+from typing import Annotated, AsyncIterator
 
-from .utils import locate_sitemap_urls
+from .cache import ResponseCache, get_cache
+from .classifier import DEFAULT_CLASSIFIER, Classifier, get_classifier
+from .client import get_client
+from .deadline import expired, get_deadline
+from .errors import BadRequest, NotFound, UpstreamTimeout, from_exception
+from .sitemap_snapshots import SnapshotStore, get_snapshot_store
+from .url_list import URLList
+from .utils import classify_sitemap_urls, crawl_sitemap_changes, discover_sitemaps, locate_sitemap_urls
 
 router = APIRouter(
     prefix="/sitemap",
     tags=['sitemap'],
     responses={
-        500: {
-            "message": "Sitemap retrieval failed",
-            "status": "Failed"
-        }
+        400: {"description": "Invalid website URL"},
+        404: {"description": "No sitemap found"},
+        502: {"description": "The website failed"},
+        503: {"description": "The website kept failing, its circuit is open"},
+        504: {"description": "The website timed out"},
     }
 )
 
 
 @router.get("/")
 async def get_sitemap(
-    url: Annotated[str, Query(title="Website URL", min_length=1)]
+    url: Annotated[str, Query(title="Website URL", min_length=1)],
+    client: Annotated[httpx.AsyncClient, Depends(get_client)],
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    stream: Annotated[bool, Query(title="Stream results as NDJSON")] = False,
+    category: Annotated[list[str] | None, Query(title="Extra category, as name:keyword,keyword")] = None,
+    deadline: Annotated[float | None, Depends(get_deadline)] = None,
 ):
-    """Retrieves the sitemap URLs of any given website in the query parameter. These include; main sitemap, blog sitemap, product sitemap and page sitemap"""
+    """Retrieves the sitemap URLs of any given website in the query parameter. These include; main sitemap, blog sitemap, product sitemap and page sitemap
+
+    With stream=true the URLs are sent as newline-delimited JSON records while the sitemap is crawled (or straight from
+    the cache when the site was crawled recently), followed by a summary record holding the status, the sitemap URL
+    and the URL count per category. Non-streamed results are cached per URL.
+
+    Every category parameter adds a category of URLs whose path holds one of its keywords, e.g.
+    category=docs:docs,guide. One named like a default category replaces its keywords.
+
+    With a time budget (timeout_ms or X-Timeout-Ms) the crawl stops when it runs out, and the URLs classified by then
+    (or only the sitemap URL) are returned with partial set. Partial results are not cached."""
+
+    if 'http' not in url.casefold():
+        raise BadRequest()
+
+    if stream:
+        classifier = get_classifier(category)
+        cached = await cache.peek('sitemap', cache_key(url, category))
+        return StreamingResponse(
+            stream_sitemap_records(url, client, deadline, classifier, cached),
+            media_type='application/x-ndjson'
+        )
+
+    # Serialized by orjson in one call, FastAPI's own encoding walks the URL lists string by string
+    return ORJSONResponse(await find_sitemap(url, client, cache, category, deadline))
+
+
+def cache_key(url: str, category: list[str] | None = None) -> str:
+    """Sitemap results are cached apart for every set of extra categories."""
+
+    return url if not category else '\n'.join([url, *category])
+
+
+async def find_sitemap(
+        url: str,
+        client: httpx.AsyncClient,
+        cache: ResponseCache,
+        category: list[str] | None = None,
+        deadline: float | None = None
+) -> dict:
+    """The /sitemap response body, for the endpoint and for the batch and job runs of it."""
+
+    if 'http' not in url.casefold():
+        raise BadRequest()
+    classifier = get_classifier(category)
 
     try:
-        if url == '' or 'http' not in url.casefold():
-            return {
-                'status': 'bad request',
-                'message': 'please include a valid url in your request',
-                'code': 400
-            }
-    except AttributeError:
-        return {
-            'status': 'bad request',
-            'message': 'please include a valid url in your request',
-            'code': 400
+        # Get sitemap results
+        sitemap_result = await cache.get_or_fetch(
+            'sitemap',
+            cache_key(url, category),
+            lambda: locate_sitemap_urls(url, client, deadline, classifier),
+            is_failure=lambda result: expired(deadline),
+            deadline=deadline,
+        )
+    except Exception as e:
+        raise from_exception(e) from e
+    partial = expired(deadline)
+
+    if not sitemap_result:
+        if partial:
+            raise UpstreamTimeout('no sitemap found in time', error='deadline_exceeded')
+        raise NotFound('no sitemap urls found', status='empty')
+
+    # Get sitemap URL and other URLs. Crawled ones come as URLLists, read back from the shared cache as lists
+    sitemap_url = sitemap_result[0]
+    other_urls = sitemap_result[1]
+    if other_urls is not None:
+        other_urls = {
+            name: urls.to_list() if isinstance(urls, URLList) else urls for name, urls in other_urls.items()
         }
 
+    # Return JSONified response
+    return {
+        'status': 'success',
+        'message': 'sitemap urls retrieved',
+        'sitemap': sitemap_url,
+        'otherUrls': other_urls,
+        'partial': partial,
+        'code': 200
+    }
+
+
+@router.get("/changes")
+async def get_sitemap_changes(
+    url: Annotated[str, Query(title="Website URL", min_length=1)],
+    client: Annotated[httpx.AsyncClient, Depends(get_client)],
+    store: Annotated[SnapshotStore, Depends(get_snapshot_store)],
+    since: Annotated[int | None, Query(title="Cursor returned by an earlier call")] = None,
+    category: Annotated[list[str] | None, Query(title="Extra category, as name:keyword,keyword")] = None,
+    deadline: Annotated[float | None, Depends(get_deadline)] = None,
+):
+    """Recrawls the website's sitemaps and returns only the URLs added, changed (new <lastmod>) or removed since the
+    crawl the since cursor came from. Pass the returned cursor on the next call.
+
+    Without a cursor, or with one too old to diff against, every current URL is returned as added and reset is true.
+    Child sitemaps whose <lastmod> in the index has not changed are not downloaded again. When a time budget cuts the
+    crawl short, the changes seen by then are returned with partial set and the rest are found by the next call.
+    Categories are assigned as in /sitemap, including any extra category parameters."""
+
+    if 'http' not in url.casefold():
+        raise BadRequest()
+    classify = get_classifier(category).classify
+
     try:
-        # Get sitemap results
-        sitemap_result = await locate_sitemap_urls(url)
+        changes = await crawl_sitemap_changes(url, client, store, since, deadline)
+    except Exception as e:
+        raise from_exception(e) from e
+
+    if changes is None:
+        raise NotFound('no sitemap urls found', status='empty')
+
+    return {
+        'status': 'success',
+        'message': 'sitemap changes retrieved',
+        'sitemap': changes['sitemap'],
+        'cursor': changes['cursor'],
+        'reset': changes['reset'],
+        'added': [
+            {'url': link, 'lastmod': lastmod, 'categories': classify(link, source)}
+            for link, lastmod, source in changes['added']
+        ],
+        'changed': [
+            {'url': link, 'lastmod': lastmod, 'categories': classify(link, source)}
+            for link, lastmod, source in changes['changed']
+        ],
+        'removed': changes['removed'],
+        'partial': changes['partial'],
+        'code': 200
+    }
 
-        if sitemap_result:
-            # Get sitemap URL and other URLs
-            sitemap_url = sitemap_result[0]
-            other_urls = sitemap_result[1]
 
-            # Return JSONified response
-            return {
+async def stream_sitemap_records(
+        url: str,
+        client: httpx.AsyncClient,
+        deadline: float | None = None,
+        classifier: Classifier = DEFAULT_CLASSIFIER,
+        cached: list | tuple | None = None
+) -> AsyncIterator[bytes]:
+    """Yields one NDJSON line per classified sitemap URL, then a final summary line.
+
+    With the cached result of a recent crawl the URLs are sent from it, a category at a time, without crawling."""
+
+    counts = {}
+    try:
+        if cached:
+            sitemap_index, other_urls = cached
+            for category, urls in (other_urls or {}).items():
+                if urls:
+                    counts[category] = len(urls)
+                    yield b''.join(orjson.dumps({'category': category, 'url': link}) + b'\n' for link in urls)
+        else:
+            sitemap_index, roots = await discover_sitemaps(url, client, deadline)
+
+            if roots and not expired(deadline):
+                async for category, link in classify_sitemap_urls(roots, client, deadline, classifier):
+                    counts[category] = counts.get(category, 0) + 1
+                    yield orjson.dumps({'category': category, 'url': link}) + b'\n'
+
+        if sitemap_index or counts:
+            summary = {
                 'status': 'success',
                 'message': 'sitemap urls retrieved',
-                'sitemap': sitemap_url,
-                'otherUrls': other_urls,
+                'sitemap': sitemap_index,
+                'otherUrls': counts,
+                'partial': not cached and expired(deadline),
                 'code': 200
             }
         else:
-            return {
-                'status': 'empty',
-                'message': 'no sitemap urls found',
-                'code': 404
-            }
+            summary = NotFound('no sitemap urls found', status='empty').body()
+
     except Exception as e:
-        return {
-            'status': 'failed',
-            'message': 'a server error has occured',
-            'code': 500,
-            'error': e
-        }
+        # The 200 status line is already sent, the failure is only reported here
+        summary = {**from_exception(e).body(), 'otherUrls': counts}
+
+    yield orjson.dumps(summary) + b'\n'
@@ -0,0 +1,327 @@
+"""Streaming sitemap parser.
+
+Sitemaps are parsed with lxml's incremental (iterparse style) parser while they download, so memory stays flat no
+matter how large the document is. Sitemap indexes are followed recursively and gzipped sitemaps are decompressed on the
+fly."""
+import os
+import zlib
+import asyncio
+from functools import partial
+from typing import AsyncIterator
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+from lxml import etree
+from bs4 import BeautifulSoup
+
+from .http_cache import HTTPCache
+from .parse_pool import run_parser
+
+
+# How many levels of nested sitemap indexes to follow
+SITEMAP_MAX_DEPTH = int(os.environ.get('SITEMAP_MAX_DEPTH') or 3)
+
+# Stop collecting once this many page URLs have been found
+SITEMAP_MAX_URLS = int(os.environ.get('SITEMAP_MAX_URLS') or 500000)
+
+# Number of child sitemaps downloaded at the same time
+SITEMAP_CONCURRENCY = int(os.environ.get('SITEMAP_CONCURRENCY') or 4)
+
+# Largest HTML sitemap that will be read into memory
+HTML_SITEMAP_MAX_BYTES = 5 * 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _is_xml(sitemap_url: str, content_type: str, head: bytes) -> bool:
+    """Decides whether a sitemap document is XML from its URL, content type and first bytes."""
+
+    if 'xml' in content_type or urlsplit(sitemap_url).path.casefold().endswith(('xml', '.gz')):
+        return True
+    head = head.lstrip()
+    return head.startswith((b'<?xml', b'<urlset', b'<sitemapindex'))
+
+
+def _drain(parser: etree.XMLPullParser) -> list[tuple[str, str, str | None]]:
+    """Collects the finished <url> and <sitemap> entries from the parser and frees them from the tree."""
+
+    records = []
+    for _, element in parser.read_events():
+        tag = element.tag
+        if not isinstance(tag, str):
+            continue
+        kind = tag.rpartition('}')[2]
+        if kind not in ('url', 'sitemap'):
+            continue
+
+        loc = lastmod = None
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            name = child.tag.rpartition('}')[2]
+            if name == 'loc':
+                loc = (child.text or '').strip()
+            elif name == 'lastmod':
+                lastmod = (child.text or '').strip() or None
+        if loc:
+            records.append((kind, loc, lastmod))
+
+        # Drop the entry and everything parsed before it
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+    return records
+
+
+def _parse_html(sitemap_url: str, content: bytes) -> list[tuple[str, str, str | None]]:
+    """Reads the links of an HTML sitemap page."""
+
+    soup = BeautifulSoup(content, 'html.parser')
+    links = [tag.get('href') for tag in soup.find_all('a') if tag.get('href') is not None]
+    # Form full URLs, leaving out the sitemap URL itself
+    links = [urljoin(sitemap_url, link) for link in links]
+    return [('url', link, None) for link in links if link != sitemap_url]
+
+
+async def _parse_response(
+        sitemap_url: str,
+        response: httpx.Response,
+        state: dict | None = None
+) -> AsyncIterator[tuple[str, str, str | None]]:
+    """Parses a sitemap response body as it downloads, yielding its (kind, loc, lastmod) entries.
+
+    An HTML sitemap larger than HTML_SITEMAP_MAX_BYTES is only parsed up to the limit, which sets state['truncated']
+    when a state dictionary is given."""
+
+    content_type = response.headers.get('content-type', '').casefold()
+
+    decompressor = None
+    parser = None
+    html = None
+    started = False
+
+    async for chunk in response.aiter_bytes():
+        if not started:
+            started = True
+            # Gzip files served as plain bytes (not Content-Encoding) are decompressed here
+            if chunk.startswith(GZIP_MAGIC):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+
+        if parser is None and html is None:
+            if not chunk.strip():
+                continue
+            if _is_xml(sitemap_url, content_type, chunk[:256]):
+                parser = etree.XMLPullParser(
+                    events=('end',),
+                    recover=True,
+                    resolve_entities=False,
+                    no_network=True,
+                )
+            else:
+                html = bytearray()
+
+        if parser is not None:
+            parser.feed(chunk)
+            for record in _drain(parser):
+                yield record
+        else:
+            html.extend(chunk)
+            if len(html) > HTML_SITEMAP_MAX_BYTES:
+                if state is not None:
+                    state['truncated'] = True
+                break
+
+    if decompressor is not None and parser is not None:
+        parser.feed(decompressor.flush())
+
+    if parser is not None:
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        for record in _drain(parser):
+            yield record
+
+    elif html is not None:
+        for record in await run_parser(partial(_parse_html, sitemap_url), bytes(html)):
+            yield record
+
+
+async def stream_sitemap(
+        sitemap_url: str,
+        client: httpx.AsyncClient
+) -> AsyncIterator[tuple[str, str, str | None]]:
+    """Downloads one sitemap document and yields its entries as they are parsed.
+
+    Fully read documents are kept in the client's HTTP cache with their validators. While fresh they are replayed
+    without a request, and once stale a 304 replays them without downloading or parsing again.
+
+    :param sitemap_url: URL of an XML, gzipped XML or HTML sitemap
+    :param client: Shared HTTP client
+
+    Yields (kind, loc, lastmod) tuples where kind is 'url' for pages and 'sitemap' for child sitemaps."""
+
+    cache = getattr(client, 'http_cache', None)
+    key = ('sitemap', sitemap_url)
+    entry = cache.lookup(key) if cache is not None else None
+
+    if entry is not None and cache.is_fresh(entry):
+        cache.fresh_hits += 1
+        for record in entry[0]:
+            yield record
+        return
+
+    async with client.stream(
+        'GET',
+        sitemap_url,
+        headers={'User-Agent': 'ResearchEngine', **HTTPCache.conditional_headers(entry)}
+    ) as response:
+        if response.status_code == 304 and entry is not None:
+            cache.revalidated += 1
+            cache.refresh(key, entry, response)
+            for record in entry[0]:
+                yield record
+            return
+
+        response.raise_for_status()
+        if cache is None:
+            async for record in _parse_response(sitemap_url, response):
+                yield record
+            return
+
+        # Keep the entries for the cache, as long as the document is read to the end and is not too large to keep
+        records = []
+        state = {}
+        async for record in _parse_response(sitemap_url, response, state):
+            if records is not None:
+                records.append(record)
+                if len(records) > SITEMAP_MAX_URLS:
+                    records = None
+            yield record
+
+        cache.misses += 1
+        if records is not None and not state.get('truncated'):
+            cache.store(key, tuple(records), response, size=len(records) or 1)
+
+
+async def expand_sitemaps(
+        roots: list[str],
+        client: httpx.AsyncClient,
+        max_depth: int = SITEMAP_MAX_DEPTH,
+        max_urls: int = SITEMAP_MAX_URLS,
+        previous: dict[str, str] | None = None,
+        index: dict[str, tuple[str | None, str | None, str]] | None = None,
+        deadline: float | None = None,
+) -> AsyncIterator[tuple[str, str | None, str]]:
+    """Follows the given sitemaps and any nested sitemap indexes under them, downloading up to SITEMAP_CONCURRENCY
+    documents at once.
+
+    :param roots: Sitemap URLs to start from
+    :param client: Shared HTTP client
+    :param max_depth: Levels of nested indexes to follow below the roots
+    :param max_urls: Maximum number of page URLs to yield
+    :param previous: Child sitemap URL: <lastmod> from an earlier crawl. Children an index still lists with the same
+        lastmod are not fetched again
+    :param index: When given, it is filled with sitemap URL: (parent, lastmod, state) for every sitemap met, where state
+        is 'fetched' (read to the end and every URL in it yielded), 'skipped' (unchanged since previous) or 'failed'
+        (failed, or cut short by max_urls or the deadline)
+    :param deadline: Event loop time at which to stop, cancelling the downloads still running
+
+    Yields (url, lastmod, sitemap_url) for every page URL found, as soon as it is parsed. Sitemaps that fail to
+    download or parse are skipped, unless every root failed without an HTTP answer (an unreachable host or an open
+    circuit): that transport error is raised then."""
+
+    # Bounded so a slow consumer holds back the downloads instead of buffering them
+    queue = asyncio.Queue(maxsize=1000)
+    semaphore = asyncio.Semaphore(SITEMAP_CONCURRENCY)
+    seen = set(roots)
+    tasks = set()
+    pending = 0
+    done = object()
+    # Transport errors of the roots
+    unreachable = []
+
+    async def crawl(sitemap_url: str, depth: int) -> None:
+        nonlocal pending
+        try:
+            async with semaphore:
+                async for kind, loc, lastmod in stream_sitemap(sitemap_url, client):
+                    if kind == 'sitemap':
+                        if depth < max_depth and loc not in seen:
+                            seen.add(loc)
+                            spawn(loc, depth + 1, sitemap_url, lastmod)
+                    else:
+                        await queue.put((loc, lastmod, sitemap_url))
+            # Marks the end of the sitemap's URLs in the queue
+            await queue.put((None, None, sitemap_url))
+        except Exception as e:
+            if index is not None:
+                index[sitemap_url] = (*index[sitemap_url][:2], 'failed')
+            if not depth and isinstance(e, httpx.TransportError):
+                unreachable.append(e)
+
+        # The last crawl to finish tells the consumer there is nothing more coming
+        pending -= 1
+        if not pending:
+            await queue.put(done)
+
+    def spawn(sitemap_url: str, depth: int, parent: str | None = None, lastmod: str | None = None) -> None:
+        nonlocal pending
+        # Unchanged children are left for the caller to take from its earlier crawl
+        if previous and lastmod and previous.get(sitemap_url) == lastmod:
+            if index is not None:
+                index[sitemap_url] = (parent, lastmod, 'skipped')
+            return
+
+        if index is not None:
+            index[sitemap_url] = (parent, lastmod, 'fetched')
+        pending += 1
+        task = asyncio.create_task(crawl(sitemap_url, depth))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    for root in dict.fromkeys(roots):
+        spawn(root, 0)
+
+    loop = asyncio.get_running_loop()
+    count = 0
+    # Sitemaps whose URLs have all been yielded
+    finished = set()
+    try:
+        while count < max_urls:
+            if deadline is None:
+                item = await queue.get()
+            elif not queue.empty():
+                # Entries already parsed are taken even past the deadline, that costs no waiting. Taking them without a
+                # timer also keeps this cheap, a crawl can yield hundreds of thousands of them
+                item = queue.get_nowait()
+            elif loop.time() >= deadline:
+                break
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            if item is done:
+                break
+            if item[0] is None:
+                finished.add(item[2])
+                continue
+            count += 1
+            yield item
+
+        if unreachable and len(unreachable) == len(set(roots)):
+            raise unreachable[0]
+
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        if index is not None:
+            for sitemap_url, (parent, lastmod, state) in index.items():
+                if state == 'fetched' and sitemap_url not in finished:
+                    index[sitemap_url] = (parent, lastmod, 'failed')
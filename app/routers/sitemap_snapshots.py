@@ -0,0 +1,192 @@
+"""Sitemap snapshots for incremental crawls.
+
+The last crawl of every site is kept in a local SQLite file: each URL with its <lastmod> and the sitemap that listed it,
+and every sitemap with its parent and the <lastmod> its index gave it. Each crawl that changes something bumps the
+site's version, and every URL records the version it was added, changed and removed in. The version works as a cursor,
+so the changes since any earlier crawl are a query away, and removed URLs are kept for SITEMAP_SNAPSHOT_KEEP versions.
+"""
+import os
+import asyncio
+import sqlite3
+import threading
+
+from fastapi import Request
+
+from .locks import KeyedLocks
+
+
+SITEMAP_SNAPSHOT_PATH = os.environ.get('SITEMAP_SNAPSHOT_PATH') or 'sitemap_snapshots.sqlite3'
+
+# Versions removed URLs are remembered for. Older cursors get the full URL list again
+SITEMAP_SNAPSHOT_KEEP = int(os.environ.get('SITEMAP_SNAPSHOT_KEEP') or 30)
+
+
+class SnapshotStore:
+    """Versioned sitemap URLs per site."""
+
+    def __init__(self, path: str = SITEMAP_SNAPSHOT_PATH, keep: int = SITEMAP_SNAPSHOT_KEEP) -> None:
+        self.keep = keep
+        # One crawl per site at a time
+        self.locks = KeyedLocks()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sites ('
+            'site TEXT PRIMARY KEY, sitemap TEXT, version INTEGER NOT NULL, floor INTEGER NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS urls ('
+            'site TEXT NOT NULL, url TEXT NOT NULL, lastmod TEXT, sitemap TEXT NOT NULL, added INTEGER NOT NULL, '
+            'changed INTEGER NOT NULL, removed INTEGER, PRIMARY KEY (site, url))'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sitemaps ('
+            'site TEXT NOT NULL, url TEXT NOT NULL, parent TEXT, lastmod TEXT, PRIMARY KEY (site, url))'
+        )
+
+    def tree_sync(self, site: str) -> dict[str, tuple[str | None, str | None]]:
+        """Returns sitemap URL: (parent, lastmod) for every sitemap of the site's last crawl."""
+
+        with self._lock:
+            rows = self._db.execute('SELECT url, parent, lastmod FROM sitemaps WHERE site = ?', (site,)).fetchall()
+        return {url: (parent, lastmod) for url, parent, lastmod in rows}
+
+    def apply_sync(
+            self,
+            site: str,
+            sitemap: str | None,
+            seen: dict[str, tuple[str | None, str]],
+            held: set[str],
+            tree: dict[str, tuple[str | None, str | None]],
+            complete: bool,
+    ) -> int:
+        """Records a crawl of the site and returns its version, bumped only when a URL was added, changed or removed.
+
+        :param site: Site URL
+        :param sitemap: Sitemap index URL
+        :param seen: URL: (lastmod, sitemap URL) for every URL found in this crawl
+        :param held: Sitemaps that were not read this time, their URLs from the last crawl are kept as they are
+        :param tree: Sitemap URL: (parent, lastmod) for every sitemap of this crawl
+        :param complete: False when the crawl stopped early, so missing URLs are not taken as removed"""
+
+        with self._lock:
+            row = self._db.execute('SELECT version, floor FROM sites WHERE site = ?', (site,)).fetchone()
+            version, floor = row or (0, 0)
+            new = version + 1
+
+            live = {
+                url: (lastmod, source) for url, lastmod, source in self._db.execute(
+                    'SELECT url, lastmod, sitemap FROM urls WHERE site = ? AND removed IS NULL', (site,)
+                )
+            }
+
+            added = []
+            changed = []
+            moved = []
+            for url, (lastmod, source) in seen.items():
+                old = live.get(url)
+                if old is None:
+                    added.append((site, url, lastmod, source, new, new))
+                elif old[0] != lastmod:
+                    changed.append((lastmod, source, new, site, url))
+                elif old[1] != source:
+                    moved.append((source, site, url))
+
+            removed = []
+            if complete:
+                removed = [
+                    (new, site, url) for url, (_, source) in live.items() if url not in seen and source not in held
+                ]
+
+            if added or changed or removed:
+                version = new
+
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany(
+                    'INSERT INTO urls (site, url, lastmod, sitemap, added, changed, removed) '
+                    'VALUES (?, ?, ?, ?, ?, ?, NULL) ON CONFLICT (site, url) DO UPDATE SET '
+                    'lastmod = excluded.lastmod, sitemap = excluded.sitemap, added = excluded.added, '
+                    'changed = excluded.changed, removed = NULL',
+                    added
+                )
+                self._db.executemany(
+                    'UPDATE urls SET lastmod = ?, sitemap = ?, changed = ? WHERE site = ? AND url = ?', changed
+                )
+                self._db.executemany('UPDATE urls SET sitemap = ? WHERE site = ? AND url = ?', moved)
+                self._db.executemany('UPDATE urls SET removed = ? WHERE site = ? AND url = ?', removed)
+
+                # Forget removals too old for any cursor still served
+                if version - self.keep > floor:
+                    floor = version - self.keep
+                    self._db.execute('DELETE FROM urls WHERE site = ? AND removed <= ?', (site, floor))
+
+                self._db.execute('DELETE FROM sitemaps WHERE site = ?', (site,))
+                self._db.executemany(
+                    'INSERT INTO sitemaps (site, url, parent, lastmod) VALUES (?, ?, ?, ?)',
+                    [(site, url, parent, lastmod) for url, (parent, lastmod) in tree.items()]
+                )
+                self._db.execute(
+                    'INSERT OR REPLACE INTO sites (site, sitemap, version, floor) VALUES (?, ?, ?, ?)',
+                    (site, sitemap, version, floor)
+                )
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+        return version
+
+    def changes_sync(self, site: str, since: int | None) -> dict:
+        """Returns the URLs added, changed and removed after the since version. An unknown or expired cursor resets:
+        every current URL comes back as added."""
+
+        with self._lock:
+            row = self._db.execute('SELECT sitemap, version, floor FROM sites WHERE site = ?', (site,)).fetchone()
+            sitemap, version, floor = row or (None, 0, 0)
+
+            reset = since is None or since < floor or since > version
+            if reset:
+                since = 0
+
+            added = self._db.execute(
+                'SELECT url, lastmod, sitemap FROM urls WHERE site = ? AND removed IS NULL AND added > ? ORDER BY url',
+                (site, since)
+            ).fetchall()
+            changed = self._db.execute(
+                'SELECT url, lastmod, sitemap FROM urls '
+                'WHERE site = ? AND removed IS NULL AND added <= ? AND changed > ? ORDER BY url',
+                (site, since, since)
+            ).fetchall()
+            removed = self._db.execute(
+                'SELECT url FROM urls WHERE site = ? AND removed > ? AND added <= ? ORDER BY url',
+                (site, since, since)
+            ).fetchall()
+
+        return {
+            'sitemap': sitemap,
+            'cursor': version,
+            'reset': reset,
+            'added': added,
+            'changed': changed,
+            'removed': [url for url, in removed],
+        }
+
+    async def tree(self, site: str) -> dict[str, tuple[str | None, str | None]]:
+        return await asyncio.to_thread(self.tree_sync, site)
+
+    async def apply(self, *args) -> int:
+        return await asyncio.to_thread(self.apply_sync, *args)
+
+    async def changes(self, site: str, since: int | None) -> dict:
+        return await asyncio.to_thread(self.changes_sync, site, since)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def get_snapshot_store(request: Request) -> SnapshotStore:
+    """Dependency that hands routers the store opened in the app lifespan."""
+
+    return request.app.state.snapshot_store
@@ -0,0 +1,169 @@
+"""Persistent transcript store.
+
+Published transcripts rarely change, so every transcript fetched from YouTube is kept in a local SQLite file keyed by
+video ID and the language it resolved to. Segments are stored as zlib compressed JSON. Once the file grows past its size
+limit, the least recently read transcripts are evicted.
+
+Transcripts for a list of videos can be loaded ahead of time, from the app directory:
+
+    python -m routers.transcript_store VIDEO_ID [VIDEO_ID ...]
+    python -m routers.transcript_store --file video_ids.txt
+"""
+import os
+import sys
+import time
+import zlib
+import sqlite3
+import asyncio
+import argparse
+import threading
+
+import orjson
+from fastapi import Request
+
+
+TRANSCRIPT_STORE_PATH = os.environ.get('TRANSCRIPT_STORE_PATH') or 'transcripts.sqlite3'
+TRANSCRIPT_STORE_MAX_MB = float(os.environ.get('TRANSCRIPT_STORE_MAX_MB') or 512)
+
+
+class TranscriptStore:
+    """Transcripts on disk, keyed by (video_id, language)."""
+
+    def __init__(self, path: str = TRANSCRIPT_STORE_PATH, max_bytes: int = int(TRANSCRIPT_STORE_MAX_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS transcripts ('
+            'video_id TEXT NOT NULL, language TEXT NOT NULL, segments BLOB NOT NULL, size INTEGER NOT NULL, '
+            'accessed REAL NOT NULL, PRIMARY KEY (video_id, language))'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS transcripts_accessed ON transcripts (accessed)')
+
+        # Running total of the stored sizes, one row kept up to date by put_sync, so an insert does not have to scan
+        # the whole table. Kept in the file rather than in memory since every worker process writes to it
+        self._db.execute('CREATE TABLE IF NOT EXISTS transcripts_size (total INTEGER NOT NULL)')
+        self._db.execute('BEGIN IMMEDIATE')
+        self._db.execute(
+            'INSERT INTO transcripts_size (total) SELECT (SELECT COALESCE(SUM(size), 0) FROM transcripts) '
+            'WHERE NOT EXISTS (SELECT 1 FROM transcripts_size)'
+        )
+        self._db.execute('COMMIT')
+
+    def get_sync(self, video_id: str, languages: list[str]) -> tuple[str, list[dict]] | None:
+        """Returns the stored language and segments of a video, taking the earliest language in the list that is
+        stored."""
+
+        with self._lock:
+            rows = dict(self._db.execute(
+                'SELECT language, segments FROM transcripts WHERE video_id = ?', (video_id,)
+            ).fetchall())
+            language = next((language for language in languages if language in rows), None)
+            if language is None:
+                return None
+
+            self._db.execute(
+                'UPDATE transcripts SET accessed = ? WHERE video_id = ? AND language = ?',
+                (time.time(), video_id, language)
+            )
+
+        return language, orjson.loads(zlib.decompress(rows[language]))
+
+    def put_sync(self, video_id: str, language: str, segments: list[dict]) -> None:
+        """Stores the segments of a video, then evicts the least recently read transcripts if over the size limit."""
+
+        blob = zlib.compress(orjson.dumps(segments))
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._put(video_id, language, blob)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _put(self, video_id: str, language: str, blob: bytes) -> None:
+        # A replaced transcript gives back its old size
+        replaced = self._db.execute(
+            'SELECT size FROM transcripts WHERE video_id = ? AND language = ?', (video_id, language)
+        ).fetchone()
+        self._db.execute(
+            'INSERT OR REPLACE INTO transcripts (video_id, language, segments, size, accessed) VALUES (?, ?, ?, ?, ?)',
+            (video_id, language, blob, len(blob), time.time())
+        )
+        grown = len(blob) - (replaced[0] if replaced else 0)
+        total = self._db.execute('UPDATE transcripts_size SET total = total + ? RETURNING total', (grown,)).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Evict down to 90% of the limit so the next few inserts do not evict again
+        target = total - self.max_bytes * 0.9
+        freed = 0
+        evict = []
+        for key_video, key_language, size in self._db.execute(
+            'SELECT video_id, language, size FROM transcripts ORDER BY accessed'
+        ):
+            if freed >= target:
+                break
+            evict.append((key_video, key_language))
+            freed += size
+        self._db.executemany('DELETE FROM transcripts WHERE video_id = ? AND language = ?', evict)
+        self._db.execute('UPDATE transcripts_size SET total = total - ?', (freed,))
+
+    async def get(self, video_id: str, languages: list[str]) -> tuple[str, list[dict]] | None:
+        return await asyncio.to_thread(self.get_sync, video_id, languages)
+
+    async def put(self, video_id: str, language: str, segments: list[dict]) -> None:
+        await asyncio.to_thread(self.put_sync, video_id, language, segments)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def get_transcript_store(request: Request) -> TranscriptStore:
+    """Dependency that hands routers the store opened in the app lifespan."""
+
+    return request.app.state.transcript_store
+
+
+def warm(video_ids: list[str], store: TranscriptStore) -> None:
+    """Downloads and stores the transcripts of the given videos that are not stored yet."""
+
+    from .yt_transcript import LANGUAGES, download_transcript
+
+    for video_id in video_ids:
+        if store.get_sync(video_id, LANGUAGES) is not None:
+            print(f'{video_id}: stored')
+            continue
+        try:
+            language, segments = download_transcript(video_id)
+        except Exception as e:
+            print(f'{video_id}: failed ({type(e).__name__})')
+            continue
+        store.put_sync(video_id, language, segments)
+        print(f'{video_id}: {language}, {len(segments)} segments')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Preload transcripts into the transcript store.')
+    parser.add_argument('video_ids', nargs='*', help='YouTube video IDs')
+    parser.add_argument('--file', help='File with one video ID per line')
+    args = parser.parse_args()
+
+    video_ids = list(args.video_ids)
+    if args.file:
+        with open(args.file) as file:
+            video_ids.extend(line.strip() for line in file if line.strip())
+    if not video_ids:
+        parser.error('no video IDs given')
+
+    store = TranscriptStore()
+    try:
+        warm(video_ids, store)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Compact URL lists.
+
+A large site's sitemap lists hundreds of thousands of URLs, nearly all on the same host. Held as a list of strings, every
+URL repeats its scheme and host and costs a Python object of its own. A URLList interns the scheme and host (origin) of
+its URLs, keeping an origin number per URL in an array, and joins the rest of each URL, its path, into chunks of
+URL_CHUNK_SIZE paths. That is one string per chunk instead of one per URL.
+
+Membership and diff need a set of the URLs, which the crawl filling the list never does. It is only built on the first
+lookup, one set of paths per origin, and kept up to date from then on."""
+import re
+from array import array
+from typing import Any, Iterable, Iterator
+
+
+# Paths joined into one string
+URL_CHUNK_SIZE = 4096
+
+# Scheme and host of a URL, the part that is interned
+_ORIGIN = re.compile(r'[a-zA-Z][a-zA-Z0-9+.\-]*://[^/?#]*')
+
+
+def split_url(url: str) -> tuple[str, str]:
+    """Splits a URL into its origin and the rest. Strings that are not absolute URLs are kept whole as the path."""
+
+    match = _ORIGIN.match(url)
+    if match is None:
+        return '', url
+    return match.group(), url[match.end():]
+
+
+class URLList:
+    """Insertion-ordered URLs stored as interned origins and chunks of paths. Paths are joined with newlines, which a
+    URL cannot hold, so one found in a URL is stored percent-encoded."""
+
+    def __init__(self, urls: Iterable[str] = ()) -> None:
+        self._origins = []
+        self._origin_ids = {}
+        # Origin number of every URL
+        self._hosts = array('I')
+        # Paths joined with newlines for every full chunk, then the paths of the chunk being filled
+        self._chunks = []
+        self._tail = []
+        # Origin of the last URL added, with a slash after it, and its number
+        self._prefix = None
+        self._host = 0
+        # Origin: set of its paths, built on the first lookup
+        self._index = None
+
+        self.extend(urls)
+
+    def append(self, url: str) -> None:
+        self.extend((url,))
+
+    def extend(self, urls: Iterable[str]) -> None:
+        origins = self._origins
+        origin_ids = self._origin_ids
+        hosts = self._hosts
+        chunks = self._chunks
+        tail = self._tail
+        index = self._index
+        prefix = self._prefix
+        host = self._host
+        cut = len(prefix) - 1 if prefix is not None else 0
+
+        for url in urls:
+            # Sitemaps list a host's URLs together, most URLs start with the origin of the one before and a slash
+            if prefix is not None and url.startswith(prefix):
+                number = host
+                path = url[cut:]
+            else:
+                origin, path = split_url(url)
+                number = origin_ids.get(origin)
+                if number is None:
+                    number = origin_ids[origin] = len(origins)
+                    origins.append(origin)
+                if origin:
+                    prefix = origin + '/'
+                    host = number
+                    cut = len(origin)
+
+            if '\n' in path:
+                path = path.replace('\n', '%0A')
+            hosts.append(number)
+            tail.append(path)
+            if index is not None:
+                index.setdefault(origins[number], set()).add(path)
+            if len(tail) >= URL_CHUNK_SIZE:
+                chunks.append('\n'.join(tail))
+                tail = []
+
+        self._tail = tail
+        self._prefix = prefix
+        self._host = host
+
+    def _runs(self) -> Iterator[tuple[array, list[str]]]:
+        """(origin numbers, paths) for every chunk, the one being filled last."""
+
+        start = 0
+        for chunk in self._chunks:
+            paths = chunk.split('\n')
+            yield self._hosts[start:start + len(paths)], paths
+            start += len(paths)
+        if self._tail:
+            yield self._hosts[start:], self._tail
+
+    def __len__(self) -> int:
+        return len(self._hosts)
+
+    def __iter__(self) -> Iterator[str]:
+        origins = self._origins
+        for hosts, paths in self._runs():
+            for host, path in zip(hosts, paths):
+                yield origins[host] + path
+
+    def __contains__(self, url: Any) -> bool:
+        if not isinstance(url, str):
+            return False
+        origin, path = split_url(url)
+        return path in self._lookup().get(origin, ())
+
+    def __repr__(self) -> str:
+        return f'URLList({len(self)} URLs on {len(self._origins)} hosts)'
+
+    def _lookup(self) -> dict[str, set[str]]:
+        if self._index is None:
+            origins = self._origins
+            index = {origin: set() for origin in origins}
+            for hosts, paths in self._runs():
+                for host, path in zip(hosts, paths):
+                    index[origins[host]].add(path)
+            self._index = index
+        return self._index
+
+    def diff(self, other: 'URLList') -> list[str]:
+        """URLs of this list that are not in the other, in this list's order."""
+
+        index = other._lookup()
+        held = [index.get(origin, ()) for origin in self._origins]
+        origins = self._origins
+        missing = []
+        for hosts, paths in self._runs():
+            missing.extend(origins[host] + path for host, path in zip(hosts, paths) if path not in held[host])
+        return missing
+
+    def to_list(self) -> list[str]:
+        origins = self._origins
+        return [origins[host] + path for hosts, paths in self._runs() for host, path in zip(hosts, paths)]
+
+
+def encode(value: Any) -> list[str]:
+    """orjson default hook, writes URLLists as JSON arrays."""
+
+    if isinstance(value, URLList):
+        return value.to_list()
+    raise TypeError
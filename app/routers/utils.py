@@ -1,9 +1,23 @@
-import requests
-from bs4 import BeautifulSoup
+import os
+import time
+import heapq
+import asyncio
+import httpx
+from typing import Any, AsyncIterator, Awaitable
 from googlesearch import search
 from collections import deque, Counter
 from urllib.parse import urljoin, urlsplit
-from requests.exceptions import HTTPError, ConnectionError
+from requests.exceptions import RequestException
+
+from .breaker import CircuitBreaker, CircuitOpenError
+from .client import CrawlClient
+from .deadline import expired, within
+from .metrics import STAGE_LATENCY, span
+from .robots import RobotsCache
+from .classifier import DEFAULT_CLASSIFIER, Classifier
+from .sitemap_parser import expand_sitemaps
+from .sitemap_snapshots import SnapshotStore
+from .url_list import URLList
 
 
 
@@ -16,313 +30,456 @@ def remove_keys(search_results: list[dict[str, str]], remove_list: list[str]) ->
                 dictionary.pop(key)
 
 
-def reorder(search_results: list[dict]):
-    """Reorders the search results to ensure that no more than 2 same sites appear in every 10 blocks"""
-
-    # Add search results to a deque
-    temp_results = deque()
-    temp_results.extend(search_results)
+def reorder(
+        search_results: list[dict], 
+        max_per_site: int = 2, 
+        block_size: int = 10
+) -> list[dict]:
+    """Reorders the search results to ensure that no more than max_per_site same sites appear in every block of
+    block_size results.
 
-    display_links = {result['displayLink'] for result in temp_results}
+    Each position takes the earliest remaining result whose site still has room in the current block, so the order
+    is stable and deterministic. Results are kept in one queue per site and the queue heads sit in a heap, which makes
+    the whole pass O(n log k) for k sites. When every remaining site is full for the block, the earliest remaining
+    result is placed anyway, since the limit cannot be met."""
 
-    # Counter object
-    counter = Counter(display_links)
+    # Queue of (original position, result) per site
+    queues = {}
+    for index, result in enumerate(search_results):
+        queues.setdefault(result['displayLink'], deque()).append((index, result))
 
-    def reset_counters():
-        for key in counter:
-            counter[key] = 0
+    # Heads of the sites with room in the current block, and of the sites that are full
+    available = [(queue[0][0], site) for site, queue in queues.items()]
+    heapq.heapify(available)
+    full = []
+    counter = Counter()
 
-    # New list and block tracker
     new_results = []
-    block_tracker = 0
-
-    while temp_results:
-        # Get next result and add to new reordered list
-        result = temp_results.pop()
-
-        # Reset trackers to 0 after every block of 10
-        if block_tracker % 10 == 0:
-            reset_counters()
-        
-        # Put back into queue if up to 2 of the same site are in block already
-        if counter.get(result['displayLink']) == 2:
-            temp_results.append(result)
-            block_tracker += 1
-            continue
-
-        # Add result to new list and increase tracker count
-        new_results.append(result)
-        counter[result['displayLink']] += 1
-        
-        # Increment block count
-        block_tracker += 1
+    while available or full:
+        # Start a new block, every site has room again
+        if len(new_results) % block_size == 0:
+            for entry in full:
+                heapq.heappush(available, entry)
+            full = []
+            counter.clear()
+
+        if available:
+            _, site = heapq.heappop(available)
+        else:
+            # Every remaining site is full for this block, take the earliest result regardless.
+            # At most block_size / max_per_site sites can be full at once
+            entry = min(full)
+            full.remove(entry)
+            _, site = entry
+
+        queue = queues[site]
+        new_results.append(queue.popleft()[1])
+        counter[site] += 1
+
+        if queue:
+            entry = (queue[0][0], site)
+            if counter[site] >= max_per_site:
+                full.append(entry)
+            else:
+                heapq.heappush(available, entry)
 
-    new_results.reverse()
     return new_results
 
 
-def crawl_with_addons(url: str) -> str | None:
-    """Appends common sitemap URL strings to a URL in an attempt to locate the sitemap URL."""
-    
-    addons = [
-        'sitemap',
-        'sitemap.xml',
-        'sitemap_index.xml',
-        'wp-sitemap.xml',
-        'sitemap/index.xml',
-    ]
-    
-    # print(f"-> Crawling {url} with addons")
-    for addon in addons:
-        try:
-            # Form URL with added string
-            addon_url = urljoin(url, addon)
-            
-            # Test next endpoint to find root sitemap URL
-            response = requests.get(
-                url=addon_url,
-                # allow_redirects=redirects,
-                headers={'User-Agent': 'ResearchEngine'}
-            )
-            
-            code = response.status_code
-            response_url = response.url
-            
-            # OK response and sitemap in the response URL (not redirected)
-            if code == 200:
-                if 'sitemap' in response_url.casefold():
-                    return response_url
-                else:
-                    continue
-
-            # Handle redirection
-            elif code == 301:
-                continue
-            
-            # If neither 200 nor 301, break and move to the next addon
-            else:
-                # print(f'{addon}: {code}')
-                continue
-        
-        # Retry with redirect enabled if the test endpoint fails
-        except requests.ConnectionError as e:
-            # print(f'{addon}: failed')
-            continue
-    
-    return None
+# Common sitemap locations, in the order they are preferred
+SITEMAP_ADDONS = [
+    'sitemap',
+    'sitemap.xml',
+    'sitemap_index.xml',
+    'wp-sitemap.xml',
+    'sitemap/index.xml',
+]
 
+# Time budget for the whole sitemap discovery in seconds
+DISCOVERY_TIMEOUT = float(os.environ.get('SITEMAP_DISCOVERY_TIMEOUT') or 20)
 
-def crawl_robots(url: str) -> list[str] | None:
-    """Crawls a website's robots.txt file if one exists to get the all sitemap URLs listed on it.
-    
-    :param url: Website root URL
-    
-    Returns a list of the sitemap URLs or None."""
+# Seconds allowed for each request of the Google search fallback
+GOOGLE_SEARCH_TIMEOUT = float(os.environ.get('GOOGLE_SEARCH_TIMEOUT') or 5)
 
-    url = urljoin(url, 'robots.txt')
+# Most URLs read by one /sitemap/changes crawl. Sitemaps read to the end are skipped by the next crawl while unchanged,
+# so a larger site is covered over several calls
+SITEMAP_CHANGES_MAX_URLS = int(os.environ.get('SITEMAP_CHANGES_MAX_URLS') or 200000)
 
-    try:
-        response = requests.get(
-            url=url,
-            headers={
-                # Refer to notes for why you did this
-                'User-Agent': 'ResearchEngine'
-            }
-        )
-        response.raise_for_status()
+# Skips the Google search fallback for a while once Google keeps failing or blocking it
+google_breaker = CircuitBreaker('google')
+
+
+async def first_by_priority(
+        probes: list[Awaitable[Any]], 
+        deadline: float
+) -> tuple[int, Any] | None:
+    """Runs all probes at once and returns the index and result of the highest priority probe (earliest in the list) that
+    returns something truthy. Lower priority probes are cancelled as soon as a winner is certain.
+
+    :param probes: Awaitables in priority order
+    :param deadline: Event loop time by which a result must be chosen
+
+    If the deadline passes, the best result gathered so far is returned."""
 
-    except HTTPError as e:
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(probe) for probe in probes]
+    pending = set(tasks)
+
+    def winner() -> tuple[int, Any] | None:
+        # A result wins only once every probe ahead of it has finished empty handed
+        for index, task in enumerate(tasks):
+            if not task.done():
+                return None
+            if not task.cancelled() and task.exception() is None and task.result():
+                return index, task.result()
         return None
-    
-    except ConnectionError:
+
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            _, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if found := winner():
+                return found
+
+        # Out of time, settle for the best finished probe
+        for index, task in enumerate(tasks):
+            if task.done() and not task.cancelled() and task.exception() is None and task.result():
+                return index, task.result()
         return None
 
-    # Split robots.txt lines
-    robots_file = response.text
-    lines = robots_file.split('\n')
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def probe_addon(addon_url: str, client: httpx.AsyncClient) -> str | None:
+    """Requests a single candidate sitemap URL and returns the final URL if it holds a sitemap.
 
-    # Parse sitemaps from file lines
-    sitemaps = [line for line in lines if 'Sitemap:' in line]
-    sitemaps = [sitemap.split('Sitemap:')[-1].strip() for sitemap in sitemaps]
+    Raises the transport error when there is no HTTP answer (unreachable host, timeout or open circuit)."""
 
-    # Remove compressed sitemap URL files
-    sitemaps = [sitemap for sitemap in sitemaps if not sitemap.endswith('gz')]
+    try:
+        response = await client.get(
+            url=addon_url,
+            headers={'User-Agent': 'ResearchEngine'}
+        )
+    except httpx.TransportError:
+        raise
+    except httpx.HTTPError:
+        return None
+
+    # OK response and sitemap in the response URL (not redirected elsewhere)
+    response_url = str(response.url)
+    if response.status_code == 200 and 'sitemap' in response_url.casefold():
+        return response_url
+
+    return None
 
-    # Convert to set and back to remove duplicate links
-    sitemaps = list(set(sitemaps))
+
+async def crawl_robots(url: str, client: httpx.AsyncClient) -> list[str] | None:
+    """Reads a website's robots.txt file if one exists to get the all sitemap URLs listed on it. The shared client
+    keeps the parsed file per host, and its Crawl-delay is passed on to the scheduler.
+    
+    :param url: Website root URL
+    :param client: Shared HTTP client
+    
+    Returns a list of the sitemap URLs or None."""
+
+    if isinstance(client, CrawlClient):
+        rules = await client.robots.get(url, client)
+        delay = rules.crawl_delay()
+        if delay:
+            client.scheduler.set_crawl_delay(urlsplit(url).hostname, delay)
+    else:
+        rules = await RobotsCache().get(url, client)
 
     # TODO: For single link return, that's the sitemap index, return it alone
 
-    return sitemaps or None
+    return rules.sitemaps or None
 
 
-def crawl_google(url: str) -> str | None:
+async def crawl_google(url: str) -> str | None:
     """Performs a Google search for the site URL, filetype XML as such:
 
     site:url filetype:xml inurl:sitemap.
     
+    The search library is synchronous, so it runs in a worker thread to keep the event loop free.
+    
     Returns the link of the first result of the Google search."""
     
     term = f"site:{url} filetype:xml inurl:sitemap"
-    try:
-        results = search(
+
+    def run_search() -> list[str]:
+        return list(search(
             term=term, 
             num_results=1,
             sleep_interval=3,
-        )
-        if not results:
-            return None
-        
-    except HTTPError as e:
+            timeout=GOOGLE_SEARCH_TIMEOUT,
+        ))
+
+    try:
+        google_breaker.check()
+    except CircuitOpenError:
+        return None
+
+    try:
+        results = await asyncio.to_thread(run_search)
+    except RequestException as e:
+        google_breaker.failure()
+        return None
+    except BaseException:
+        google_breaker.release()
+        raise
+
+    google_breaker.success()
+    if not results:
         return None
     
     # Get link from results and return as sitemap URL
-    return list(results) or None
+    return results[0]
 
 
-def crawl_sitemap_index(
+async def classify_sitemap_urls(
         sitemap_url: str | list[str], 
-        single: bool = True
-) -> dict[str, list[str]] | None:
-    """Crawls the XML sitemap index of the site to find the pages, blogs and products sitemap indexes"""
+        client: httpx.AsyncClient,
+        deadline: float | None = None,
+        classifier: Classifier = DEFAULT_CLASSIFIER
+) -> AsyncIterator[tuple[str, str]]:
+    """Crawls the sitemap (or list of sitemaps) of the site and any nested sitemap indexes under it, yielding
+    (category, url) pairs for pages, blogs and products (or the classifier's categories) while the sitemaps stream in.
+    The crawl stops at the deadline, keeping what was classified until then.
+
+    Every URL is classified once, the first time it is listed, and yielded in the order found. URLs matching no
+    category are held back and yielded as pages at the end, only if no pages or blogs were found."""
+
+    roots = [sitemap_url] if isinstance(sitemap_url, str) else sitemap_url
+    classify = classifier.classify
+
+    # URLs already classified, the unmatched ones in first-seen order, and whether any page or blog was found
+    seen = set()
+    unmatched = {}
+    primary = False
+
+    # Time spent classifying, the rest of the loop is spent waiting for the sitemaps
+    classify_time = 0.0
+
+    async for link, _, source in expand_sitemaps(roots, client, deadline=deadline):
+        if link in seen:
+            continue
+        seen.add(link)
+
+        start = time.perf_counter()
+        categories = classify(link, source)
+        classify_time += time.perf_counter() - start
 
-    result_urls = {
-        ('pages', 'page'): [],
-        ('products', 'product'): [],
-        ('blogs', 'blog', 'post', 'posts'): [],
-    }
-    final_dict = {}
+        if not categories:
+            unmatched[link] = None
+            continue
+        if not primary:
+            primary = 'pages' in categories or 'blogs' in categories
+        for name in categories:
+            yield name, link
+
+    STAGE_LATENCY.observe('classify', value=classify_time)
+
+    # FALLBACK FOR BLOGS AND PAGES
+    if not primary:
+        for link in unmatched:
+            yield 'pages', link
+
+
+async def crawl_sitemap_index(
+        sitemap_url: str | list[str], 
+        client: httpx.AsyncClient,
+        deadline: float | None = None,
+        classifier: Classifier = DEFAULT_CLASSIFIER
+) -> dict[str, URLList] | None:
+    """Crawls the sitemap (or list of sitemaps) of the site to find the pages, blogs and products URLs (or those of the
+    classifier's categories), or as many as were found by the deadline. The URLs are kept in URLLists, which hold a
+    large site in a third of the memory of lists of strings.
+    
+    Returns None when no URLs could be collected."""
+
+    final_dict = {name: [] for name in classifier.names}
 
     # print(f'-> Collecting sitemap URLs')
-    try:
-        # If more than one link was found on the sitemap index, just classify by blogs and add the rest to pages
-        if not single:
-            final_dict = {
-                'pages': [],
-                'blogs': [],
-            }
-            for key in result_urls.keys():
-                for url in sitemap_url:
-                    path = urlsplit(url).path
-                    if 'blog' in path.casefold():
-                        final_dict['blogs'].append(url)
-                    else:
-                        final_dict['pages'].append(url)
-            # Remove duplicates
-            for key, value in final_dict.items():
-                final_dict[key] = list(set(value))
-            return final_dict
-
-        response = requests.get(
-            url=sitemap_url,
-            headers={
-                # Refer to notes for why you did this
-                'User-Agent': 'ResearchEngine'
-            }
-        )
-        response.raise_for_status()
+    # classify_sitemap_urls yields every URL at most once per category, the lists need no de-duplication
+    async for name, link in classify_sitemap_urls(sitemap_url, client, deadline, classifier):
+        final_dict[name].append(link)
 
-        # Parse for both HTML and XML sitemaps
-        if sitemap_url.endswith('xml'):
-            soup = BeautifulSoup(response.content, 'xml')
-            tags = soup.find_all('loc')
-            links = [tag.text for tag in tags]
-        else:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            tags = soup.find_all('a')
-            tags = [tag for tag in tags if tag.get('href') is not None]
-            links = [tag.get('href') for tag in tags]
-            # Form full URLs
-            links = [urljoin(sitemap_url, link) for link in links]
-            # Remove sitemap URL if it is repeated in links
-            try:
-                links.remove(sitemap_url)
-            except ValueError:
-                pass
-
-        # Get pages, blogs and products
-        for key in result_urls.keys():
-            for link in links:
-                # print(f"Checking {link}")
-                path = urlsplit(link).path
-                # If any of the key search words exists in the link path, add it
-                if any(k in path.casefold() for k in key):
-                    # add = links.pop(links.index(link))
-                    result_urls[key].append(link)
-
-        # Strip keys back to single words
-        for key, value in result_urls.items():
-            key = key[0]
-            final_dict[key] = value
-
-        # FALLBACK FOR BLOGS AND PAGES
-        if not final_dict['blogs'] and not final_dict['pages']:
-            for link in links:
-                path = urlsplit(link).path
-                if 'blog' in path.casefold():
-                    final_dict['blogs'].append(link)
-                else:
-                    final_dict['pages'].append(link)
-
-        # Remove duplicates
-        for key, value in final_dict.items():
-            final_dict[key] = list(set(value))
-
-        return final_dict
-
-    except HTTPError as e:
-        # print(f"HTTP Error: {e.response.status_code}")
+    if not any(final_dict.values()):
         return None
+
+    # Compacted once the crawl is over, the strings are held by the crawl until then anyway
+    return {name: URLList(links) for name, links in final_dict.items()}
+
+
+async def crawl_sitemap_changes(
+        url: str,
+        client: httpx.AsyncClient,
+        store: SnapshotStore,
+        since: int | None = None,
+        deadline: float | None = None
+) -> dict | None:
+    """Crawls the site's sitemaps against its last snapshot and returns what changed since the since cursor.
+
+    Child sitemaps that their index lists with the same <lastmod> as last time are not fetched, their URLs (and any
+    sitemaps nested under them) are carried over from the snapshot. Sitemaps that fail to download, or that the deadline
+    or SITEMAP_CHANGES_MAX_URLS cut short, are carried over the same way and fetched again next time, with their
+    indexes. The crawl is then partial.
+
+    Returns the store's changes dictionary, or None when no sitemap was found."""
+
+    async with store.locks[url]:
+        sitemap_index, roots = await discover_sitemaps(url, client, deadline)
+        if not roots:
+            return None
+
+        roots = [roots] if isinstance(roots, str) else roots
+        previous_tree = await store.tree(url)
+        previous = {sitemap: lastmod for sitemap, (_, lastmod) in previous_tree.items() if lastmod}
+
+        index = {}
+        seen = {}
+        count = 0
+        async for link, lastmod, source in expand_sitemaps(
+                roots, client, max_urls=SITEMAP_CHANGES_MAX_URLS, previous=previous, index=index, deadline=deadline
+        ):
+            count += 1
+            seen.setdefault(link, (lastmod, source))
+
+        partial = expired(deadline) or count >= SITEMAP_CHANGES_MAX_URLS
+
+        # The indexes above a sitemap not read to the end lose their lastmod too, or the next crawl would skip them and
+        # never reach it again
+        unread = set()
+        stack = [sitemap for sitemap, (_, _, state) in index.items() if state == 'failed']
+        while stack:
+            sitemap = stack.pop()
+            if sitemap in index and sitemap not in unread:
+                unread.add(sitemap)
+                stack.append(index[sitemap][0])
+
+        # Sitemaps not read this time, and everything nested under them, keep their URLs from the snapshot
+        children = {}
+        for sitemap, (parent, _) in previous_tree.items():
+            children.setdefault(parent, []).append(sitemap)
+        held = set()
+        stack = [sitemap for sitemap, (_, _, state) in index.items() if state != 'fetched']
+        while stack:
+            sitemap = stack.pop()
+            if sitemap not in held:
+                held.add(sitemap)
+                stack.extend(children.get(sitemap, []))
+
+        tree = {}
+        for sitemap in held:
+            if sitemap not in index and sitemap in previous_tree:
+                tree[sitemap] = previous_tree[sitemap]
+        for sitemap, (parent, lastmod, _) in index.items():
+            # Stored without its lastmod so it is fetched again next time
+            tree[sitemap] = (parent, None if sitemap in unread else lastmod)
+
+        await store.apply(url, sitemap_index, seen, held, tree, not partial)
+        changes = await store.changes(url, since)
+        changes['partial'] = partial
+        return changes
+
+
+async def discover_sitemaps(
+        url: str, 
+        client: httpx.AsyncClient,
+        deadline: float | None = None
+) -> tuple[str | None, str | list[str] | None]:
+    """Locates a website's sitemap URL by probing the addons and the robots.txt file at the same time. Addon results are
+    preferred over robots.txt, in the order of SITEMAP_ADDONS. If both fail, it falls back to a Google search.
     
-    except Exception as e:
-        # print(f"Exception: {e}")
-        return None
+    The whole discovery shares a single DISCOVERY_TIMEOUT budget, cut shorter by the request's deadline.
+    
+    Returns the sitemap index URL and the sitemap(s) to crawl. When none of the addons got an HTTP answer, the site is
+    down rather than without a sitemap, and their transport error (or CircuitOpenError) is raised instead."""
 
+    loop = asyncio.get_running_loop()
+    deadline = within(deadline, DISCOVERY_TIMEOUT)
 
-async def locate_sitemap_urls(url: str) -> tuple[str, dict[str, list[str]]] | None:
+    # Transport errors of the addon probes
+    errors = []
+
+    async def probe(addon_url: str) -> str | None:
+        try:
+            return await probe_addon(addon_url, client)
+        except httpx.TransportError as e:
+            errors.append(e)
+            raise
+
+    # Try with addons and robots.txt together, robots.txt has the lowest priority
+    probes = [probe(urljoin(url, addon)) for addon in SITEMAP_ADDONS]
+    probes.append(crawl_robots(url, client))
+    found = await first_by_priority(probes, deadline)
+
+    if not found and len(errors) == len(SITEMAP_ADDONS):
+        raise next((e for e in errors if isinstance(e, CircuitOpenError)), errors[0])
+
+    if found and found[0] < len(SITEMAP_ADDONS):
+        # Found with addons
+        return found[1], found[1]
+
+    elif found:
+        # Found with robots.txt
+        results = found[1]
+        if len(results) == 1:
+            return results[0], results[0]
+
+        # Select the index sitemap
+        sitemap_index = None
+        for result in results:
+            path = urlsplit(result).path.casefold()
+            if 'index.xml' in path or \
+            'sitemap_index.xml' in path or \
+            'sitemap-index.xml' in path or \
+            'sitemap-index-0.xml' in path or \
+            'sitemap/index.xml' in path :
+                sitemap_index = result
+                break
+        return sitemap_index, results
+
+    elif (remaining := deadline - loop.time()) > 0:
+        # Try Google search with whatever time is left
+        try:
+            results = await asyncio.wait_for(crawl_google(url), timeout=remaining)
+        except asyncio.TimeoutError:
+            results = None
+        if results:
+            return results, results
+
+    return None, None
+
+
+async def locate_sitemap_urls(
+        url: str, 
+        client: httpx.AsyncClient,
+        deadline: float | None = None,
+        classifier: Classifier = DEFAULT_CLASSIFIER
+) -> tuple[str, dict[str, URLList]] | None:
     """Full function
 
-    1. Locates a website's sitemap URL starting with the addons method. If that fails, it moves on to parse the robots.txt file
-    2. If both fail, it essentially returns None.
+    1. Discovers the website's sitemap URL with discover_sitemaps
+    2. Crawls it to classify the pages, blogs and products
+    3. If nothing was found, it essentially returns None.
+
+    Both stages stop at the deadline: the URLs classified by then are returned, or only the sitemap index when the
+    discovery used up the time.
     
     Returns a dictionary of all the sitemap classifications needed."""
 
     sitemap_urls = None
-    sitemap_index = None
+    with span('discover'):
+        sitemap_index, roots = await discover_sitemaps(url, client, deadline)
 
-    # Try with addons
-    results = crawl_with_addons(url)
-    if not results:
-        # Try with robots.txt
-        results = crawl_robots(url)
-        if results:
-            if len(results) == 1:
-                sitemap_index = results[0]
-                sitemap_urls = crawl_sitemap_index(results[0])
-            else:
-                # Select the index sitemap
-                for result in results:
-                    path = urlsplit(result).path.casefold()
-                    if 'index.xml' in path or \
-                    'sitemap_index.xml' in path or \
-                    'sitemap-index.xml' in path or \
-                    'sitemap-index-0.xml' in path or \
-                    'sitemap/index.xml' in path :
-                        sitemap_index = result
-                        break
-                sitemap_urls = crawl_sitemap_index(results, single=False)
-        else:
-            # Try Google search
-            results = crawl_google(url)
-            if results:
-                sitemap_index = results
-                sitemap_urls = crawl_sitemap_index(results)
-            else:
-                pass
-    else:
-        sitemap_index = results
-        # If URL was found with addons, crawl and get page, blog and products
-        sitemap_urls = crawl_sitemap_index(results)
+    if roots and not expired(deadline):
+        with span('crawl'):
+            sitemap_urls = await crawl_sitemap_index(roots, client, deadline, classifier)
 
     return_tuple = (sitemap_index, sitemap_urls)
     return return_tuple if any(return_tuple) else None
@@ -1,54 +1,253 @@
 """YouTube transcript router"""
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import Annotated
-from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptAvailable
+import requests
+from typing import Annotated, Literal
+from youtube_transcript_api._errors import (
+    TranscriptsDisabled,
+    NoTranscriptAvailable,
+    TooManyRequests,
+    YouTubeRequestFailed,
+)
+from youtube_transcript_api._transcripts import TranscriptListFetcher
+
+from fastapi import APIRouter, Depends, Query, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 
-from fastapi import APIRouter, Query, Response
+from .breaker import CircuitBreaker, CircuitOpenError
+from .cache import ResponseCache, get_cache
+from .errors import APIError, CircuitOpen, NotFound, UpstreamError, UpstreamTimeout
+from .metrics import span
+from .transcript_store import TranscriptStore, get_transcript_store
 
 # Define API Router
 router = APIRouter(
     prefix="/transcript",
     tags=['transcript'],
     responses={
-        400: {"message": "Please include a valid video ID"}
+        400: {"message": "Please include a valid video ID"},
+        404: {"description": "The video has no transcript"},
+        502: {"description": "YouTube failed"},
+        503: {"description": "YouTube kept failing, its circuit is open"},
+        504: {"description": "YouTube timed out"},
     }
 )
 
+# Transcript languages in order of preference
+LANGUAGES = ['en', 'hi', 'ur', 'es', 'fr', 'de', 'zh-Hans', 'zh-Hant', 'ar', 'pt', 'it', 'ja', 'ko']
+
+# The transcript library is synchronous, its calls run on this pool to keep the event loop free
+TRANSCRIPT_WORKERS = int(os.environ.get('TRANSCRIPT_WORKERS') or 8)
+executor = ThreadPoolExecutor(max_workers=TRANSCRIPT_WORKERS, thread_name_prefix='transcript')
+
+# Transcript requests sent to YouTube per second, shared by every request on this worker
+TRANSCRIPT_RATE = float(os.environ.get('TRANSCRIPT_RATE') or 5)
+
+# Most video IDs accepted in one batch
+TRANSCRIPT_BATCH_MAX = int(os.environ.get('TRANSCRIPT_BATCH_MAX') or 200)
+
+
+class RateLimiter:
+    """Spaces calls out so no more than rate of them start per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+rate_limiter = RateLimiter(TRANSCRIPT_RATE)
+
+# Seconds allowed for downloading one transcript. Also set on every request the library sends, so a worker thread is
+# not held forever by a connection that hangs
+TRANSCRIPT_TIMEOUT = float(os.environ.get('TRANSCRIPT_TIMEOUT') or 15)
+
+# Stops calling YouTube for a while once it keeps failing or throttling
+youtube_breaker = CircuitBreaker('youtube')
+
+
+# Output formats, see format_transcript
+TranscriptFormat = Literal['segments', 'text', 'chunks']
+
+
+class TranscriptBatch(BaseModel):
+    video_ids: list[str] = Field(min_length=1, max_length=TRANSCRIPT_BATCH_MAX)
+    format: TranscriptFormat = 'segments'
+    window: float = Field(default=60, gt=0)
+
+
+def format_transcript(
+        transcript: list[dict] | dict,
+        format: TranscriptFormat = 'segments',
+        window: float = 60
+) -> list[dict] | dict | str:
+    """Merges transcript segments on the server.
+
+    :param transcript: Segments from YouTube, failure messages are returned as they are
+    :param format: 'segments' for the segments as fetched, 'text' for the whole transcript as one string or 'chunks' for
+    the text grouped into windows of window seconds
+    :param window: Chunk length in seconds"""
+
+    if isinstance(transcript, dict) or format == 'segments':
+        return transcript
+
+    if format == 'text':
+        return ' '.join(segment['text'] for segment in transcript)
+
+    chunks = []
+    texts = []
+    chunk_index = None
+    end = 0
+    for segment in transcript:
+        index = int(segment['start'] // window)
+        if index != chunk_index:
+            if texts:
+                chunks.append({'start': chunk_index * window, 'end': end, 'text': ' '.join(texts)})
+            chunk_index = index
+            texts = []
+        texts.append(segment['text'])
+        end = segment['start'] + segment['duration']
+
+    if texts:
+        chunks.append({'start': chunk_index * window, 'end': end, 'text': ' '.join(texts)})
+
+    return chunks
+
+
 """Path Operations"""
-@router.get(path="/", status_code=200)
+@router.get(path="/", status_code=200, response_class=ORJSONResponse)
 async def get_transcript(
-    video_id: Annotated[str, Query(title="Video ID", min_length=1)]
+    video_id: Annotated[str, Query(title="Video ID", min_length=1)],
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    store: Annotated[TranscriptStore, Depends(get_transcript_store)],
+    format: Annotated[TranscriptFormat, Query(title="Output format")] = 'segments',
+    window: Annotated[float, Query(title="Chunk length in seconds", gt=0)] = 60,
+) -> Response:
+    """Takes a YouTube video's ID and retrieves the transcript from it, as segments, text or chunks (see
+    format_transcript). Results are cached per video."""
+
+    transcript = await cached_transcript(video_id, cache, store)
+    if isinstance(transcript, dict):
+        # Failures cached before they carried a code were all disabled or unavailable transcripts
+        return ORJSONResponse(transcript, status_code=transcript.get('code', 404))
+    return ORJSONResponse(format_transcript(transcript, format, window))
+
+
+async def cached_transcript(video_id: str, cache: ResponseCache, store: TranscriptStore) -> list[dict] | dict:
+    """Returns the transcript segments of a video from the cache, fetching them on a miss."""
+
+    return await cache.get_or_fetch(
+        'transcript',
+        video_id,
+        lambda: fetch_transcript(video_id, store),
+        # Disabled and unavailable transcripts are cached for a shorter time, server errors are not cached
+        is_empty=lambda result: isinstance(result, dict),
+        is_failure=lambda result: isinstance(result, dict) and result['code'] >= 500,
+    )
+
+
+@router.post(path="/batch", status_code=200, response_class=ORJSONResponse)
+async def get_transcripts(
+    batch: TranscriptBatch,
+    cache: Annotated[ResponseCache, Depends(get_cache)],
+    store: Annotated[TranscriptStore, Depends(get_transcript_store)],
 ) -> Response:
-    """Takes a YouTube video's ID and retrieves the transcript from it."""
+    """Retrieves the transcripts of many videos at once. Returns the transcript or failure message of every video,
+    keyed by video ID, in the requested format."""
+
+    video_ids = list(dict.fromkeys(batch.video_ids))
+    results = await asyncio.gather(*(
+        cached_transcript(video_id, cache, store)
+        for video_id in video_ids
+    ))
+
+    return ORJSONResponse({
+        video_id: format_transcript(transcript, batch.format, batch.window)
+        for video_id, transcript in zip(video_ids, results)
+    })
+
+
+class TimeoutSession(requests.Session):
+    """Session that gives up on a request after TRANSCRIPT_TIMEOUT seconds without a response."""
+
+    def request(self, *args, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', TRANSCRIPT_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+def download_transcript(video_id: str) -> tuple[str, list[dict]]:
+    """Downloads the transcript of a video in the first available language of LANGUAGES. Returns the language code
+    and the segments."""
+
+    # What YouTubeTranscriptApi.list_transcripts does, with a session that times out
+    with TimeoutSession() as session:
+        transcript = TranscriptListFetcher(session).fetch(video_id).find_transcript(LANGUAGES)
+        return transcript.language_code, transcript.fetch()
+
+
+async def fetch_transcript(video_id: str, store: TranscriptStore) -> list[dict] | dict:
+    """Retrieves the transcript of a video from the transcript store, or from YouTube, or a failure message with the
+    status code to answer it with.
+    
+    YouTube requests wait for the shared rate limit, then run on the transcript thread pool for at most
+    TRANSCRIPT_TIMEOUT seconds. Downloaded transcripts are kept in the store."""
 
     try:
-        transcript = YouTubeTranscriptApi.get_transcript(
-            video_id=video_id, 
-            languages=['en', 'hi', 'ur', 'es', 'fr', 'de', 'zh-Hans', 'zh-Hant', 'ar', 'pt', 'it', 'ja', 'ko']
-        )
+        stored = await store.get(video_id, LANGUAGES)
+        if stored is not None:
+            return stored[1]
+
+        youtube_breaker.check()
+        try:
+            await rate_limiter.wait()
+            with span('transcript_download'):
+                language, transcript = await asyncio.wait_for(
+                    asyncio.get_running_loop().run_in_executor(executor, download_transcript, video_id),
+                    TRANSCRIPT_TIMEOUT
+                )
+        except (asyncio.TimeoutError, requests.RequestException, TooManyRequests, YouTubeRequestFailed):
+            youtube_breaker.failure()
+            raise
+        except Exception:
+            # Failures of the video itself, YouTube answered
+            youtube_breaker.success()
+            raise
+        except BaseException:
+            youtube_breaker.release()
+            raise
+        youtube_breaker.success()
         # formatter = JSONFormatter()
         # json_formatted = formatter.format_transcript(transcript)
 
+        await store.put(video_id, language, transcript)
         return transcript
 
     except TranscriptsDisabled as e:
-        return {
-            "status": "failed",
-            "message": "Transcript disabled",
-            "error": e
-        }
+        return NotFound("Transcript disabled", error='transcript_disabled', detail=str(e)).body()
 
     except NoTranscriptAvailable as e:
-        return {
-            "status": "failed",
-            "message": "Transcript unavailable",
-            "error": e
-        }
+        return NotFound("Transcript unavailable", error='transcript_unavailable', detail=str(e)).body()
+
+    except CircuitOpenError as e:
+        return CircuitOpen(detail=str(e)).body()
+
+    except (asyncio.TimeoutError, requests.Timeout) as e:
+        return UpstreamTimeout("YouTube timed out", detail=str(e) or type(e).__name__).body()
+
+    except (requests.RequestException, TooManyRequests, YouTubeRequestFailed) as e:
+        return UpstreamError("Server exception", detail=str(e)).body()
 
     except Exception as e:
-        return {
-            "status": "failed",
-            "message": "Server exception",
-            "error": e
-        }
+        return APIError("Server exception", detail=str(e)).body()
@@ -0,0 +1,160 @@
+"""Benchmark of sitemap link classification on large URL sets.
+
+Compares, on the same URLs:
+- legacy: the original crawl_sitemap_index loop, one pass over every link per category with urlsplit and casefold in
+  each, de-duplicated with list(set(...))
+- per-link: classify_link as it was before the classifier module, one urlsplit per link and a keyword scan per
+  category, de-duplicated with one set per category
+- classifier: routers.classifier.Classifier, one regex pass per link, de-duplicated once in order
+- pipeline: crawl_sitemap_index end to end, with the sitemap download replaced by the in-memory URLs
+
+each with the default categories and with extra user-defined ones. Run from the repository root:
+
+    python benchmarks/bench_classify.py
+    python benchmarks/bench_classify.py --urls 200000 --repeat 1
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from routers import utils
+from routers.classifier import get_classifier, parse_rules
+
+EXTRA_CATEGORIES = [
+    'docs:docs,guide,manual',
+    'careers:careers,jobs',
+    'support:support,help,faq',
+    'events:events,webinar',
+    'legal:privacy,terms,legal',
+    'news:news,press',
+    'shop:shop,cart,collections',
+    'team:about,team',
+]
+
+
+def make_urls(count: int, duplicates: float = 0.1) -> list[tuple[str, str]]:
+    """(url, sitemap url) pairs over a few hosts, with a share of repeated URLs as large sites list them."""
+
+    rng = random.Random(0)
+    kinds = (
+        'blog/post', 'page', 'products/item', '2024/article', 'about/team', 'docs/guide', 'category/shoes',
+        'news/press-release', 'support/faq', 'collections/summer',
+    )
+    urls = []
+    for index in range(count):
+        if urls and rng.random() < duplicates:
+            urls.append(urls[rng.randrange(len(urls))])
+            continue
+        host = f'https://www.site{index % 5}.example'
+        path = f'/{kinds[rng.randrange(len(kinds))]}-{index}/some-longer-slug-{rng.randrange(10 ** 6)}'
+        query = '?ref=sitemap' if index % 7 == 0 else ''
+        urls.append((host + path + query, f'{host}/sitemaps/{kinds[index % len(kinds)].split("/")[0]}-sitemap.xml'))
+    return urls
+
+
+def legacy(urls: list[tuple[str, str]], rules: dict[str, tuple[str, ...]]) -> dict[str, list[str]]:
+    links = [url for url, _ in urls]
+    result_urls = {(name, *keywords): [] for name, keywords in rules.items()}
+    for key in result_urls.keys():
+        for link in links:
+            path = urlsplit(link).path
+            if any(k in path.casefold() for k in key[1:]):
+                result_urls[key].append(link)
+    return {key[0]: list(set(value)) for key, value in result_urls.items()}
+
+
+def per_link(urls: list[tuple[str, str]], rules: dict[str, tuple[str, ...]]) -> dict[str, list[str]]:
+    def classify_link(link: str, sitemap_url: str | None = None) -> list[str]:
+        path = urlsplit(link).path.casefold()
+        matched = [name for name, keys in rules.items() if any(k in path for k in keys)]
+        if not matched and sitemap_url:
+            sitemap_path = urlsplit(sitemap_url).path.casefold()
+            for name, keys in rules.items():
+                if any(k in sitemap_path for k in keys):
+                    return [name]
+        return matched
+
+    seen = {name: set() for name in rules}
+    final = {name: [] for name in rules}
+    for link, source in urls:
+        for name in classify_link(link, source):
+            if link not in seen[name]:
+                seen[name].add(link)
+                final[name].append(link)
+    return final
+
+
+def classifier(urls: list[tuple[str, str]], specs: list[str]) -> dict[str, list[str]]:
+    engine = get_classifier(specs)
+    classify = engine.classify
+    seen = set()
+    final = {name: [] for name in engine.names}
+    for link, source in urls:
+        if link in seen:
+            continue
+        seen.add(link)
+        for name in classify(link, source):
+            final[name].append(link)
+    return final
+
+
+def pipeline(urls: list[tuple[str, str]], specs: list[str]) -> dict[str, list[str]]:
+    async def expand_sitemaps(roots, client, deadline=None):
+        for link, source in urls:
+            yield link, None, source
+
+    utils.expand_sitemaps = expand_sitemaps
+    final = asyncio.run(utils.crawl_sitemap_index(['memory'], None, classifier=get_classifier(specs)))
+    return {name: urls.to_list() for name, urls in final.items()}
+
+
+def timed(function, *args, repeat: int) -> tuple[float, dict]:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark sitemap link classification.')
+    parser.add_argument('--urls', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, the best is reported')
+    args = parser.parse_args()
+
+    urls = make_urls(args.urls)
+    print(f'{len(urls)} URLs, {len(set(url for url, _ in urls))} distinct')
+    print(f"{'categories':<12}{'implementation':<16}{'seconds':>10}{'URLs/s':>14}{'speedup':>10}")
+
+    for specs in ([], EXTRA_CATEGORIES):
+        rules = parse_rules(specs)
+        runs = [
+            ('legacy', legacy, rules),
+            ('per-link', per_link, rules),
+            ('classifier', classifier, specs),
+            ('pipeline', pipeline, specs),
+        ]
+        baseline = None
+        results = {}
+        for name, function, argument in runs:
+            seconds, results[name] = timed(function, urls, argument, repeat=args.repeat)
+            baseline = baseline or seconds
+            print(
+                f'{len(rules):<12}{name:<16}{seconds:>10.2f}{len(urls) / seconds:>14,.0f}{baseline / seconds:>9.1f}x',
+                flush=True
+            )
+
+        # Same URLs per category as the per-link version (the legacy one loses the order and the sitemap fallback)
+        for name in ('classifier', 'pipeline'):
+            assert results[name] == results['per-link'], name
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Offline load benchmark of the API endpoints against the local fixture server.
+
+Every endpoint runs in a fresh process with its own app instance, driven in-process through the ASGI transport, so its
+peak RSS is its own and no cache is shared between endpoints. Upstreams are served by benchmarks/fixture_server.py:
+sites for /blog-index and /sitemap, a CSE stand-in for /search, and transcripts for /transcript (the transcript download
+is patched to fetch them from the fixture server instead of YouTube).
+
+Reports requests, errors, throughput and p50/p95/p99 latency per endpoint, and the peak RSS of its process. Run from
+the repository root:
+
+    python benchmarks/bench_endpoints.py
+    python benchmarks/bench_endpoints.py --endpoints sitemap --requests 50 --concurrency 10 --urls 100000
+    python benchmarks/bench_endpoints.py --distinct 1 --json baseline.json
+
+By default every request asks for a different site, query or video, so caches do not answer them. --distinct N cycles
+through N of them instead, to measure the warm path.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+import multiprocessing
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fixture_server import add_arguments, config_from, serve
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+ENDPOINTS = {
+    'blog-index': lambda base, i: f'/blog-index/?url={base}/s/{i}/',
+    'sitemap': lambda base, i: f'/sitemap/?url={base}/s/{i}/',
+    'search': lambda base, i: f'/search/?q=bench+query+{i}&search_limit=30',
+    'transcript': lambda base, i: f'/transcript/?video_id=video{i}',
+}
+
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_endpoint(name: str, base: str, requests: int, concurrency: int, distinct: int, workdir: str) -> dict:
+    """Runs in its own process: starts the app against the fixture server and sends the requests."""
+
+    # Benchmark the app, not the politeness limits meant for real sites
+    os.environ.update({
+        'HTTP_HOST_RATE': '100000',
+        'HTTP_HOST_BURST': '100000',
+        'HTTP_MAX_PER_HOST': '1000',
+        'TRANSCRIPT_RATE': '100000',
+        'GSE_ENDPOINT': f'{base}/cse/v1',
+        'GSE_KEY': 'bench',
+        'GSE_ENGINE_ID': 'bench',
+        'TRANSCRIPT_STORE_PATH': os.path.join(workdir, f'{name}-transcripts.sqlite3'),
+        'SITEMAP_SNAPSHOT_PATH': os.path.join(workdir, f'{name}-snapshots.sqlite3'),
+    })
+    sys.path.insert(0, APP_DIR)
+
+    import httpx
+    import main
+    from routers import yt_transcript
+
+    def download_transcript(video_id: str) -> tuple[str, list[dict]]:
+        with urllib.request.urlopen(f'{base}/youtube/{video_id}') as response:
+            data = json.loads(response.read())
+        return data['language'], data['segments']
+
+    yt_transcript.download_transcript = download_transcript
+
+    async def drive() -> dict:
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async with main.lifespan(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+
+                async def one(i: int) -> None:
+                    nonlocal errors
+                    async with semaphore:
+                        start = time.perf_counter()
+                        response = await client.get(ENDPOINTS[name](base, i % distinct))
+                        latencies.append(time.perf_counter() - start)
+                        body = response.json()
+                        # Some routers report failures in the body with a 200
+                        failed = isinstance(body, dict) and (body.get('status') == 'failed' or 'error' in body)
+                        if response.status_code >= 400 or failed:
+                            errors += 1
+
+                start = time.perf_counter()
+                await asyncio.gather(*(one(i) for i in range(requests)))
+                elapsed = time.perf_counter() - start
+
+        return {
+            'endpoint': name,
+            'requests': requests,
+            'errors': errors,
+            'throughput': requests / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    return asyncio.run(drive())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the API endpoints against local fixtures.')
+    parser.add_argument('--endpoints', nargs='+', choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=20, help='Requests in flight at once')
+    parser.add_argument('--distinct', type=int, help='Distinct sites, queries or videos (default: one per request)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    server = context.Process(target=serve, args=(config_from(args),), kwargs={'ready': sender}, daemon=True)
+    server.start()
+    base = f'http://127.0.0.1:{receiver.recv()}'
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name in args.endpoints:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(
+                        run_endpoint,
+                        name,
+                        base,
+                        args.requests,
+                        args.concurrency,
+                        args.distinct or args.requests,
+                        workdir,
+                    ).result()
+                results.append(result)
+                print(
+                    f'{name:<12} {result["requests"]:>6} req {result["errors"]:>4} err '
+                    f'{result["throughput"]:>8.1f} req/s  p50 {result["p50_ms"]:>8.1f} ms  '
+                    f'p95 {result["p95_ms"]:>8.1f} ms  p99 {result["p99_ms"]:>8.1f} ms  '
+                    f'peak RSS {result["peak_rss_mb"]:>6.1f} MB',
+                    flush=True
+                )
+    finally:
+        server.terminate()
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Micro-benchmark of utils.reorder against the previous implementation on adversarial inputs.
+
+Run from the repository root:
+
+    python benchmarks/bench_reorder.py
+"""
+import os
+import sys
+import time
+import random
+from collections import deque, Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from routers.utils import reorder
+
+
+def legacy_reorder(search_results: list[dict]) -> tuple[list[dict], int]:
+    """The deque based reorder this replaced, returning the loop iteration count as well."""
+
+    temp_results = deque()
+    temp_results.extend(search_results)
+    counter = Counter({result['displayLink'] for result in temp_results})
+
+    new_results = []
+    block_tracker = 0
+    iterations = 0
+
+    while temp_results:
+        iterations += 1
+        result = temp_results.pop()
+
+        if block_tracker % 10 == 0:
+            for key in counter:
+                counter[key] = 0
+
+        if counter.get(result['displayLink']) == 2:
+            temp_results.append(result)
+            block_tracker += 1
+            continue
+
+        new_results.append(result)
+        counter[result['displayLink']] += 1
+        block_tracker += 1
+
+    new_results.reverse()
+    return new_results, iterations
+
+
+def make_results(sites: list[str]) -> list[dict]:
+    return [{'displayLink': site, 'link': f'https://{site}/{index}'} for index, site in enumerate(sites)]
+
+
+def inputs(size: int) -> dict[str, list[dict]]:
+    rng = random.Random(0)
+    return {
+        'single site': make_results(['a.com'] * size),
+        'one dominant site': make_results([
+            'a.com' if rng.random() < 0.9 else f'site{rng.randrange(5)}.com' for _ in range(size)
+        ]),
+        'dominant site at the end': make_results(
+            [f'site{i % 20}.com' for i in range(size // 2)] + ['a.com'] * (size - size // 2)
+        ),
+        'all distinct': make_results([f'site{i}.com' for i in range(size)]),
+    }
+
+
+def timed(function, *args, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def violations(results: list[dict], max_per_site: int = 2, block_size: int = 10) -> int:
+    """Counts the results placed beyond max_per_site in their block."""
+
+    count = 0
+    for start in range(0, len(results), block_size):
+        block = Counter(result['displayLink'] for result in results[start:start + block_size])
+        count += sum(max(0, n - max_per_site) for n in block.values())
+    return count
+
+
+def main() -> None:
+    print(f"{'input':<26}{'size':>8}{'legacy ms':>12}{'iterations':>12}{'new ms':>10}{'legacy over':>13}{'new over':>10}")
+    for size in (30, 100, 10_000):
+        for name, results in inputs(size).items():
+            legacy_output, iterations = legacy_reorder(results)
+            legacy_time = timed(legacy_reorder, results)
+            new_time = timed(reorder, results)
+            print(
+                f'{name:<26}{size:>8}{legacy_time * 1000:>12.3f}{iterations:>12}{new_time * 1000:>10.3f}'
+                f'{violations(legacy_output):>13}{violations(reorder(results)):>10}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark of the /sitemap response encoding on a large site.
+
+Compares, on the same body, FastAPI's default path for a returned dictionary (jsonable_encoder, then JSONResponse)
+with the ORJSONResponse get_sitemap returns. Run from the repository root:
+
+    python benchmarks/bench_sitemap_response.py
+    python benchmarks/bench_sitemap_response.py --urls 100000 --repeat 1
+"""
+import time
+import random
+import argparse
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+
+def make_body(count: int) -> dict:
+    """The /sitemap body of a site with count distinct URLs split over the default categories."""
+
+    rng = random.Random(0)
+    kinds = ('pages', 'products', 'blogs')
+    other_urls = {kind: [] for kind in kinds}
+    for index in range(count):
+        kind = kinds[rng.randrange(len(kinds))]
+        query = '?ref=sitemap' if index % 7 == 0 else ''
+        other_urls[kind].append(
+            f'https://www.example-site.com/{kind}/{index}-some-longer-slug-{rng.randrange(10 ** 6)}{query}'
+        )
+    return {
+        'status': 'success',
+        'message': 'sitemap urls retrieved',
+        'sitemap': 'https://www.example-site.com/sitemap.xml',
+        'otherUrls': other_urls,
+        'partial': False,
+        'code': 200
+    }
+
+
+def timed(function, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the /sitemap response encoding.')
+    parser.add_argument('--urls', type=int, default=500_000)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per encoding, the best is reported')
+    args = parser.parse_args()
+
+    body = make_body(args.urls)
+    default = timed(lambda: JSONResponse(jsonable_encoder(body)).body, args.repeat)
+    direct = timed(lambda: ORJSONResponse(body).body, args.repeat)
+
+    # Same document both ways
+    assert orjson.loads(JSONResponse(jsonable_encoder(body)).body) == orjson.loads(ORJSONResponse(body).body)
+
+    print(f'{args.urls} URLs')
+    print(f"{'encoding':<28}{'seconds':>10}{'speedup':>10}")
+    print(f"{'jsonable_encoder + JSON':<28}{default:>10.3f}{1:>9.1f}x")
+    print(f"{'ORJSONResponse':<28}{direct:>10.3f}{default / direct:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark of URLList against a plain list of URL strings on a large site.
+
+Measures the memory each holds, the time to build it, to write the /sitemap body, and the membership and diff lookups
+only URLList offers without a set of its own. Run from the repository root:
+
+    python benchmarks/bench_url_list.py
+    python benchmarks/bench_url_list.py --urls 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from routers.url_list import URLList, encode
+from bench_sitemap_response import make_body
+
+
+def held(function) -> tuple[object, float]:
+    """Runs function and returns its result and the MB it still holds."""
+
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size / 1024 / 1024
+
+
+def timed(function) -> tuple[object, float]:
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark URLList against a list of URL strings.')
+    parser.add_argument('--urls', type=int, default=500_000)
+    args = parser.parse_args()
+
+    urls = [link for links in make_body(args.urls)['otherUrls'].values() for link in links]
+    text = sum(map(len, urls)) / 1024 / 1024
+
+    # Copies, so the memory counted is held by the structure and not shared with urls
+    _, list_memory = held(lambda: [link[:-1] + link[-1] for link in urls])
+    _, url_list_memory = held(lambda: URLList(link[:-1] + link[-1] for link in urls))
+
+    plain, list_build = timed(lambda: [link for link in urls])
+    url_list, url_list_build = timed(lambda: URLList(urls))
+
+    _, list_dump = timed(lambda: orjson.dumps(plain))
+    body, url_list_dump = timed(lambda: orjson.dumps(url_list, default=encode))
+    assert orjson.loads(body) == urls
+
+    queries = random.Random(0).sample(urls, min(100_000, len(urls)))
+    _, index = timed(lambda: queries[0] in url_list)
+    _, lookups = timed(lambda: sum(link in url_list for link in queries))
+    earlier = URLList(urls[:len(urls) * 4 // 5])
+    added, diff = timed(lambda: url_list.diff(earlier))
+    assert added == urls[len(urls) * 4 // 5:]
+
+    print(f'{len(urls)} URLs, {text:.1f} MB of text')
+    print(f"{'':<28}{'list':>10}{'URLList':>10}")
+    print(f"{'memory held (MB)':<28}{list_memory:>10.1f}{url_list_memory:>10.1f}")
+    print(f"{'build (s)':<28}{list_build:>10.3f}{url_list_build:>10.3f}")
+    print(f"{'JSON array (s)':<28}{list_dump:>10.3f}{url_list_dump:>10.3f}")
+    print(f'URLList set built on the first lookup in {index:.3f} s')
+    print(f'{len(queries)} membership tests in {lookups:.3f} s, diff against 80% of the URLs in {diff:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
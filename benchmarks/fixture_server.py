@@ -0,0 +1,235 @@
+"""Local stand-in for every upstream the API talks to, so the endpoints can be benchmarked offline.
+
+Serves, for any number of sites under /s/<n>/:
+- a home page with header, footer and main regions, and a blog index page with dated posts
+- a nested sitemap: sitemap.xml lists sub-indexes, which list gzipped child sitemaps of page, post and product URLs
+and, for the whole server:
+- /robots.txt
+- /cse/v1, a Google Custom Search JSON API stand-in
+- /youtube/<video_id>, transcript segments for the patched transcript download
+
+Recorded pages can replace the generated ones with --pages DIR, holding home.html and/or blog.html.
+
+Run on its own from the repository root:
+
+    python benchmarks/fixture_server.py --port 8800 --urls 20000
+"""
+import os
+import gzip
+import json
+import time
+import argparse
+import functools
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULTS = {
+    'urls': 20000,
+    'sub_indexes': 4,
+    'children': 5,
+    'posts': 30,
+    'latency_ms': 50,
+    'page_latency_ms': 0,
+    'pages': None,
+}
+
+
+def home_page(site: str) -> bytes:
+    nav = ''.join(f'<a href="{site}page/{i}">Page {i}</a>' for i in range(8))
+    paragraphs = ''.join(
+        f'<p>{"lorem ipsum dolor sit amet " * 40}<a href="{site}page/{i}">more</a></p>' for i in range(30)
+    )
+    return (
+        f'<html><head><title>Site</title></head><body>'
+        f'<header><nav>{nav}<a href="{site}blog/">Blog</a></nav></header>'
+        f'<main><h1>Welcome</h1>{paragraphs}</main>'
+        f'<footer><a href="{site}about">About</a><a href="{site}news/">News</a></footer>'
+        f'</body></html>'
+    ).encode()
+
+
+def blog_page(site: str, posts: int) -> bytes:
+    articles = ''.join(
+        f'<article><h2 class="entry-title"><a href="{site}blog/post-{i}">Post {i}</a></h2>'
+        f'<time datetime="2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}">date</time>'
+        f'<p>{"post summary text " * 30}</p></article>'
+        for i in range(posts)
+    )
+    return f'<html><body><header><a href="{site}">Home</a></header><main>{articles}</main></body></html>'.encode()
+
+
+def sitemap_index(locs: list[str]) -> bytes:
+    entries = ''.join(f'<sitemap><loc>{loc}</loc><lastmod>2024-01-01</lastmod></sitemap>' for loc in locs)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</sitemapindex>'
+    ).encode()
+
+
+def url_set(base: str, site: str, offset: int, count: int) -> bytes:
+    kinds = ('blog/post', 'page', 'product', '2024/article')
+    entries = ''.join(
+        f'<url><loc>{base}{site}{kinds[i % len(kinds)]}-{i}</loc><lastmod>2024-01-{i % 28 + 1:02d}</lastmod></url>'
+        for i in range(offset, offset + count)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</urlset>'
+    ).encode()
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = DEFAULTS
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send(self, body: bytes, content_type: str = 'text/html', status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        parts = urlsplit(self.path)
+        path = parts.path
+        config = self.config
+
+        if path == '/robots.txt':
+            return self.send(b'User-agent: *\nAllow: /\n', 'text/plain')
+
+        if path == '/cse/v1':
+            time.sleep(config['latency_ms'] / 1000)
+            query = parse_qs(parts.query)
+            return self.send(search_page(query.get('q', [''])[0], int(query.get('start', ['1'])[0])), 'application/json')
+
+        if path.startswith('/youtube/'):
+            time.sleep(config['latency_ms'] / 1000)
+            return self.send(transcript(path.rsplit('/', 1)[1]), 'application/json')
+
+        if path.startswith('/s/'):
+            body = site_document(f'http://{self.headers["Host"]}', path, config_key(config))
+            if body is None:
+                return self.send(b'not found', 'text/plain', 404)
+            time.sleep(config['page_latency_ms'] / 1000)
+            content_type = 'application/octet-stream' if path.endswith('.gz') else (
+                'application/xml' if path.endswith('.xml') else 'text/html'
+            )
+            return self.send(body, content_type)
+
+        self.send(b'not found', 'text/plain', 404)
+
+
+def config_key(config: dict) -> tuple:
+    return tuple(sorted(config.items()))
+
+
+@functools.lru_cache(maxsize=512)
+def site_document(base: str, path: str, key: tuple) -> bytes | None:
+    """Builds (and keeps) one document of a site. Sites only differ by their /s/<n>/ prefix."""
+
+    config = dict(key)
+    segments = path.strip('/').split('/')
+    if len(segments) < 2:
+        return None
+    site = f'/s/{segments[1]}/'
+    rest = '/'.join(segments[2:])
+
+    if rest == '':
+        return recorded(config, 'home.html') or home_page(site)
+    if rest == 'blog':
+        return recorded(config, 'blog.html') or blog_page(site, config['posts'])
+    if rest == 'sitemap.xml':
+        return sitemap_index([f'{base}{site}sitemaps/index-{k}.xml' for k in range(config['sub_indexes'])])
+
+    per_child = max(config['urls'] // (config['sub_indexes'] * config['children']), 1)
+    if rest.startswith('sitemaps/index-') and rest.endswith('.xml'):
+        k = int(rest[len('sitemaps/index-'):-len('.xml')])
+        return sitemap_index([f'{base}{site}sitemaps/{k}-{j}.xml.gz' for j in range(config['children'])])
+    if rest.startswith('sitemaps/') and rest.endswith('.xml.gz'):
+        k, j = (int(n) for n in rest[len('sitemaps/'):-len('.xml.gz')].split('-'))
+        offset = (k * config['children'] + j) * per_child
+        return gzip.compress(url_set(base, site, offset, per_child), compresslevel=5)
+
+    return None
+
+
+def recorded(config: dict, name: str) -> bytes | None:
+    if not config['pages']:
+        return None
+    path = os.path.join(config['pages'], name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def search_page(q: str, start: int) -> bytes:
+    """One page of CSE results. Queries ending in "empty" return nothing, the rest return 100 results in total."""
+
+    if q.endswith('empty') or start > 91:
+        return json.dumps({'kind': 'customsearch#search', 'searchInformation': {'totalResults': '0'}}).encode()
+
+    items = [
+        {
+            'kind': 'customsearch#result',
+            'title': f'{q} result {i}',
+            'link': f'https://site{i % 7}.example/{q}/{i}',
+            'displayLink': f'site{i % 7}.example',
+            'snippet': 'A result snippet ' * 5,
+            'cacheId': f'cache{i}',
+        }
+        for i in range(start, start + 10)
+    ]
+    return json.dumps({'kind': 'customsearch#search', 'items': items}).encode()
+
+
+def transcript(video_id: str, segments: int = 600) -> bytes:
+    return json.dumps({
+        'language': 'en',
+        'segments': [
+            {'text': f'{video_id} segment {i} spoken words', 'start': i * 2.5, 'duration': 2.5}
+            for i in range(segments)
+        ],
+    }).encode()
+
+
+def serve(config: dict, port: int = 0, ready=None) -> None:
+    """Serves forever. With port 0 a free port is picked, and sent through the ready pipe when given."""
+
+    handler = type('Handler', (FixtureHandler,), {'config': {**DEFAULTS, **config}})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    if ready is not None:
+        ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve the benchmark fixtures.')
+    parser.add_argument('--port', type=int, default=8800)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f'Serving fixtures on http://127.0.0.1:{args.port}/s/0/')
+    serve(config_from(args), args.port)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--urls', type=int, default=DEFAULTS['urls'], help='URLs in each site\'s sitemap')
+    parser.add_argument('--sub-indexes', type=int, default=DEFAULTS['sub_indexes'], help='Nested sitemap indexes')
+    parser.add_argument('--children', type=int, default=DEFAULTS['children'], help='Gzipped sitemaps per index')
+    parser.add_argument('--posts', type=int, default=DEFAULTS['posts'], help='Posts on each blog page')
+    parser.add_argument('--latency-ms', type=float, default=DEFAULTS['latency_ms'], help='CSE and YouTube latency')
+    parser.add_argument('--page-latency-ms', type=float, default=DEFAULTS['page_latency_ms'], help='Site latency')
+    parser.add_argument('--pages', help='Directory of recorded home.html and blog.html pages')
+
+
+def config_from(args: argparse.Namespace) -> dict:
+    return {name: getattr(args, name) for name in DEFAULTS}
+
+
+if __name__ == '__main__':
+    main()